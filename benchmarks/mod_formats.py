@@ -0,0 +1,387 @@
+"""Microbenchmarks for the mod formats.
+
+Run from the repository root, no network or database is needed:
+
+    python -m benchmarks.mod_formats --files 200 --max-size 65536
+    python -m benchmarks.mod_formats --json results.json
+    python -m benchmarks.mod_formats --compare results.json --threshold 0.15
+    python -m benchmarks.mod_formats --only TroveModList --list-mods 1000 --workers 8
+    python -m benchmarks.mod_formats --verify
+
+Throughput is the best of --repeat timed runs. Memory is measured in a separate
+run under tracemalloc: peak is the highest traced usage during the call, net is
+what was still allocated when it returned and blocks is the change in live
+allocated blocks. --verify checks the optimised code against reference
+implementations instead of timing it and exits non-zero on a mismatch."""
+
+from __future__ import annotations
+
+import argparse
+import gc
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from binary_reader import BinaryReader
+
+from versions.v1.models.database.mod import (
+    ModScanCache,
+    TMod,
+    TPack,
+    TroveModFile,
+    TroveModList,
+    ZMod,
+    file_blocks,
+)
+from versions.v1.utils.functions import (
+    DecodeLeb128,
+    ReadLeb128,
+    TroveHash,
+    WriteLeb128,
+    calculate_hash,
+)
+
+
+def make_file_data(rand: random.Random, size: int) -> bytes:
+    # Repeated random runs, compressible like real blueprints but not trivially.
+    run = bytes(rand.getrandbits(8) for _ in range(rand.randint(16, 256)))
+    return (run * (size // len(run) + 1))[:size]
+
+
+def make_mod(
+    files: int = 50,
+    min_size: int = 0,
+    max_size: int = 65536,
+    distribution: str = "uniform",
+    properties: int = 4,
+    seed: int = 0,
+) -> TMod:
+    rand = random.Random(seed)
+    mod = TMod()
+    mod.mod_path = Path(f"benchmark_{seed}.tmod")
+    mod.name = f"Benchmark {seed}"
+    mod.author = "benchmark"
+    for i in range(properties):
+        mod.add_property(f"property{i}", f"value {i} " * rand.randint(1, 8))
+    for i in range(files):
+        if distribution == "lognormal":
+            size = int(rand.lognormvariate(0, 1) * (min_size + max_size) / 4)
+        else:
+            size = rand.randint(min_size, max_size)
+        size = max(min_size, min(size, max_size))
+        path = Path(f"blueprints/benchmark/dir{i % 16}/file_{i}.blueprint")
+        mod.files.append(TroveModFile(mod.cwd, path, make_file_data(rand, size)))
+    mod.reorder_files()
+    return mod
+
+
+def copy_mod(mod: TMod) -> TMod:
+    copy = TMod()
+    copy.mod_path = mod.mod_path
+    copy.properties = list(mod.properties)
+    copy.files = [
+        TroveModFile(file.cwd, Path(file.trove_path), bytes(file.data))
+        for file in mod.files
+    ]
+    return copy
+
+
+def reference_calculate_hash(data) -> int:
+    # The original word by word loop that TroveHash replaced.
+    hash_value = 0x811C9DC5
+    prime = 0x1000193
+    length = len(data)
+    length_aligned = length & ~3
+
+    for i in range(0, length_aligned, 4):
+        chunk = data[i] | (data[i + 1] << 8) | (data[i + 2] << 16) | (data[i + 3] << 24)
+        hash_value ^= chunk
+        hash_value = (hash_value * prime) & 0xFFFFFFFF
+
+    if length - length_aligned > 0:
+        remainder = length - length_aligned
+        chunk = 0
+        for i in range(remainder):
+            chunk |= data[length_aligned + i] << (i * 8)
+        hash_value ^= chunk
+        hash_value = (hash_value * prime) & 0xFFFFFFFF
+
+    return hash_value
+
+
+def verify_trove_hash(seed: int) -> list[str]:
+    """Compares calculate_hash and chunked TroveHash updates with the reference."""
+    rand = random.Random(seed)
+    sizes = [*range(0, 40), 1000, 4097, 65537, (1 << 20) + 3, (2 << 20) + 1]
+    failures = []
+    for size in sizes:
+        data = rand.randbytes(size)
+        expected = reference_calculate_hash(data)
+        for kind in (bytes, bytearray, memoryview):
+            if calculate_hash(kind(data)) != expected:
+                failures.append(f"calculate_hash({kind.__name__}) size={size}")
+        checksum = TroveHash()
+        pos = 0
+        while pos < size:
+            step = rand.choice((rand.randint(0, 7), rand.randint(0, 70000)))
+            checksum.update(data[pos : pos + step])
+            pos += step
+        if checksum.digest() != expected:
+            failures.append(f"TroveHash.update size={size}")
+    return failures
+
+
+def verify(args) -> int:
+    failures = verify_trove_hash(args.seed)
+    for failure in failures:
+        print("Mismatch:", failure)
+    print("TroveHash parity", "failed" if failures else "ok")
+    return 1 if failures else 0
+
+
+class Benchmark:
+    def __init__(self, name: str, size: int, setup, run):
+        self.name = name
+        self.size = size
+        self.setup = setup
+        self.run = run
+
+    def measure(self, repeat: int) -> dict:
+        timings = []
+        for _ in range(repeat):
+            state = self.setup()
+            gc.collect()
+            start = time.perf_counter()
+            self.run(state)
+            timings.append(time.perf_counter() - start)
+        state = self.setup()
+        gc.collect()
+        blocks = sys.getallocatedblocks()
+        tracemalloc.start()
+        result = self.run(state)
+        net, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        blocks = sys.getallocatedblocks() - blocks
+        del result
+        best = min(timings)
+        return {
+            "name": self.name,
+            "bytes": self.size,
+            "seconds": best,
+            "mb_s": self.size / best / 1e6 if best else 0.0,
+            "peak": peak,
+            "net": net,
+            "blocks": blocks,
+        }
+
+
+def make_mod_list(workdir: Path, count: int, seed: int) -> tuple[Path, int]:
+    """Writes count small mods into a fake installation, every fifth one as a zip."""
+    installation = workdir.joinpath("installation")
+    list_path = installation.joinpath("mods")
+    list_path.mkdir(parents=True)
+    size = 0
+    for i in range(count):
+        mod = make_mod(8, 256, 8192, seed=seed + i)
+        if i % 5 == 4:
+            data = mod.compile_zip_mod()
+            path = list_path.joinpath(f"{mod.name}.zip")
+        else:
+            data = mod.compile_tmod()
+            path = list_path.joinpath(f"{mod.name}.tmod")
+        path.write_bytes(data)
+        size += len(data)
+    return installation, size
+
+
+def build_benchmarks(args, workdir: Path) -> list[Benchmark]:
+    mod = make_mod(
+        args.files,
+        args.min_size,
+        args.max_size,
+        args.distribution,
+        args.properties,
+        args.seed,
+    )
+    payload_size = sum(file.size for file in mod.files)
+    tmod_data = mod.compile_tmod()
+    zip_data = mod.compile_zip_mod()
+    pack_mods = []
+    for i in range(args.pack_mods):
+        pack_mod = TMod()
+        pack_mod.mod_path = workdir.joinpath(f"benchmark_{i}.tmod")
+        pack_mod.mod_path.write_bytes(tmod_data)
+        pack_mods.append(pack_mod)
+    leb_data = b"".join(WriteLeb128(value) for value in range(0, 1 << 28, 99991))
+
+    def cold_mod():
+        file_blocks.clear()
+        return copy_mod(mod)
+
+    def new_pack():
+        pack = TPack()
+        pack.author = "benchmark"
+        pack.files.extend(pack_mods)
+        return pack
+
+    def read_leb(data):
+        reader = BinaryReader(bytearray(data))
+        pos = 0
+        while pos < len(data):
+            value = ReadLeb128(reader, pos)
+            pos += len(WriteLeb128(value))
+
+    def decode_leb(data):
+        pos = 0
+        while pos < len(data):
+            _, pos = DecodeLeb128(data, pos)
+
+    installation, list_size = make_mod_list(workdir, args.list_mods, args.seed)
+
+    def cold_list():
+        installation.joinpath("mods", ModScanCache.file_name).unlink(missing_ok=True)
+        return installation
+
+    def populate(workers):
+        return lambda installation: TroveModList(installation, workers)
+
+    return [
+        Benchmark(
+            "TMod.read_bytes",
+            len(tmod_data),
+            lambda: tmod_data,
+            lambda data: TMod.read_bytes(mod.mod_path, data),
+        ),
+        Benchmark(
+            "TMod.read_bytes+load",
+            len(tmod_data),
+            lambda: tmod_data,
+            lambda data: [
+                file.data for file in TMod.read_bytes(mod.mod_path, data).files
+            ],
+        ),
+        Benchmark(
+            "ZMod.read_bytes",
+            payload_size,
+            lambda: io.BytesIO(zip_data),
+            lambda data: ZMod.read_bytes(Path("benchmark.zip"), data),
+        ),
+        Benchmark(
+            "compile_tmod (cold)",
+            payload_size,
+            cold_mod,
+            lambda mod: mod.compile_tmod(),
+        ),
+        Benchmark(
+            "compile_zip_mod (cold)",
+            payload_size,
+            cold_mod,
+            lambda mod: mod.compile_zip_mod(),
+        ),
+        Benchmark(
+            "TPack.compile",
+            len(tmod_data) * len(pack_mods),
+            new_pack,
+            lambda pack: pack.compile(),
+        ),
+        Benchmark(
+            "calculate_hash",
+            len(tmod_data),
+            lambda: tmod_data,
+            calculate_hash,
+        ),
+        Benchmark("ReadLeb128", len(leb_data), lambda: leb_data, read_leb),
+        Benchmark("DecodeLeb128", len(leb_data), lambda: leb_data, decode_leb),
+        Benchmark("TroveModList (cold)", list_size, cold_list, populate(None)),
+        Benchmark(
+            f"TroveModList (cold, {args.workers} workers)",
+            list_size,
+            cold_list,
+            populate(args.workers),
+        ),
+        Benchmark(
+            "TroveModList (cached)", list_size, lambda: installation, populate(None)
+        ),
+    ]
+
+
+def print_results(results: list[dict]):
+    print(
+        f"{'benchmark':<36}{'MB/s':>10}{'best ms':>10}"
+        f"{'peak MiB':>10}{'net MiB':>10}{'blocks':>10}"
+    )
+    for result in results:
+        print(
+            f"{result['name']:<36}{result['mb_s']:>10.1f}"
+            f"{result['seconds'] * 1000:>10.2f}{result['peak'] / 2**20:>10.2f}"
+            f"{result['net'] / 2**20:>10.2f}{result['blocks']:>10}"
+        )
+
+
+def compare_results(results: list[dict], baseline: list[dict], threshold: float):
+    baseline = {result["name"]: result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline.get(result["name"])
+        if previous is None or not previous["mb_s"]:
+            continue
+        change = result["mb_s"] / previous["mb_s"] - 1
+        print(f"{result['name']:<36}{change:>+10.1%}")
+        if change < -threshold:
+            regressions.append(result["name"])
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=50)
+    parser.add_argument("--min-size", type=int, default=0)
+    parser.add_argument("--max-size", type=int, default=65536)
+    parser.add_argument(
+        "--distribution", choices=["uniform", "lognormal"], default="uniform"
+    )
+    parser.add_argument("--properties", type=int, default=4)
+    parser.add_argument("--pack-mods", type=int, default=4)
+    parser.add_argument("--list-mods", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", help="Only run benchmarks containing this text")
+    parser.add_argument("--json", type=Path, help="Write the results to this file")
+    parser.add_argument("--compare", type=Path, help="Results file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument(
+        "--verify", action="store_true", help="Check parity instead of timing"
+    )
+    args = parser.parse_args(argv)
+    if args.verify:
+        return verify(args)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        benchmarks = build_benchmarks(args, Path(workdir))
+        results = [
+            benchmark.measure(args.repeat)
+            for benchmark in benchmarks
+            if not args.only or args.only.lower() in benchmark.name.lower()
+        ]
+    print_results(results)
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=4))
+    if args.compare:
+        regressions = compare_results(
+            results, json.loads(args.compare.read_text()), args.threshold
+        )
+        if regressions:
+            print("Regressed:", ", ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
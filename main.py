@@ -121,6 +121,7 @@ async def startup():
             tasks.luxion.start()
             tasks.corruxion.start()
             tasks.fluxion.start()
+            tasks.build_requested_previews.start()
     else:
         await app.redis.set("main_worker", int(datetime.now(UTC).timestamp()))
         await app.redis.delete(
@@ -142,6 +143,7 @@ async def startup():
         tasks.luxion.start()
         tasks.corruxion.start()
         tasks.fluxion.start()
+        tasks.build_requested_previews.start()
     tasks.update_mods_list.start()
 
 
@@ -50,6 +50,7 @@ class Redis:
         self.set = self.server.set
         self.get = self.server.get
         self.delete = self.server.delete
+        self.incr = self.server.incr
         self.expire = self.server.expire
         self.scan_iter = self.server.scan_iter
 
@@ -64,9 +65,17 @@ class Redis:
         await self.publish(event.type.value, event)
 
     async def event_listen(self):
+        pubsub = await self.subscribe(*(channel.value for channel in EventType))
+        async for event in self.listen(pubsub):
+            yield event
+
+    async def subscribe(self, *channels):
         pubsub = self.server.pubsub()
-        for channel in EventType:
-            await pubsub.subscribe(channel.value)
+        await pubsub.subscribe(*channels)
+        return pubsub
+
+    @staticmethod
+    async def listen(pubsub):
         async for message in pubsub.listen():
             if message["type"] == "message":
                 yield pickle.loads(message["data"])
@@ -2,8 +2,13 @@ from __future__ import annotations
 
 import base64
 import io
+import json
+import mmap
 import zipfile
 import zlib
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import cache, partial
 from hashlib import md5
 from io import BytesIO
 from pathlib import Path
@@ -14,17 +19,32 @@ from binary_reader import BinaryReader
 from pydantic import BaseModel
 from toml import dumps
 
+from ...utils.cache import FileBlockCache
 from ...utils.functions import (
-    ReadLeb128,
-    WriteLeb128,
+    DecodeFileTable,
+    DecodeProperties,
+    DecodeStoredDeflate,
+    EncodeFileTableEntry,
+    EncodeProperties,
+    StoredBlockIndex,
+    TroveHash,
     calculate_hash,
-    chunks,
+    compress_stream,
+    deflate_raw,
+    file_md5,
     get_attr,
+    write_zip,
+    zip_preview_path,
 )
 from ...utils.trovesaurus import Mod, ModAuthor
 from beanie import Document, Indexed
 
 
+@cache
+def construction_image() -> bytes:
+    return Path("assets/construction.png").read_bytes()
+
+
 class NoFilesError(Exception): ...
 
 
@@ -34,6 +54,9 @@ class PropertyMalformedError(Exception): ...
 class MissingPropertyError(Exception): ...
 
 
+class ChecksumMismatchError(Exception): ...
+
+
 class Property(BaseModel):
     name: str
     value: str
@@ -51,15 +74,30 @@ class Property(BaseModel):
         return not self.__eq__(other)
 
 
+file_blocks = FileBlockCache()
+
+
 class TroveModFile:
     index: int = 0
     offset: int = 0
+    old_checksum: Optional[int] = None
+    crc32: Optional[int] = None
 
-    def __init__(self, cwd: Path, trove_path: Path, data: bytes):
+    def __init__(self, cwd: Path, trove_path: Path, data: bytes = None):
         self.cwd = cwd
         self.trove_path = trove_path.as_posix().lower()
-        self._content = BinaryReader(bytearray(data))
+        self._data = data
+        self._source = None
         self._checksum = None
+        self._content_hash = None
+
+    @classmethod
+    def from_payload(
+        cls, cwd: Path, trove_path: Path, payload: TModPayload, offset: int, size: int
+    ):
+        file = cls(cwd, trove_path)
+        file._source = (payload, offset, size)
+        return file
 
     def __str__(self):
         return f'<TroveModFile "{self.trove_path} ({self.size}" bytes)>'
@@ -69,47 +107,76 @@ class TroveModFile:
 
     @property
     def content(self) -> BinaryReader:
-        return self._content
+        return BinaryReader(bytearray(self.data))
 
     @content.setter
     def content(self, value: BinaryReader):
-        self._content = value
+        self.data = value.buffer()
 
     @property
-    def data(self) -> bytes:
-        return self.content.buffer()
+    def data(self) -> bytes | memoryview:
+        if self._data is None and self._source is not None:
+            payload, offset, size = self._source
+            self._data = payload.load(offset, size)
+        return self._data
 
     @data.setter
-    def data(self, value: bytes):
-        self.content = BinaryReader(bytearray(value))
+    def data(self, value: bytes | memoryview):
+        self._data = value
+        self._source = None
+        self._checksum = None
+        self._content_hash = None
+        self.old_checksum = None
+        self.crc32 = None
+
+    @property
+    def is_loaded(self):
+        return self._data is not None
+
+    def read(self) -> bytes | memoryview:
+        if self._data is None and self._source is not None:
+            payload, offset, size = self._source
+            self._data = payload.read_range(offset, size)
+        return self.data
 
     @property
     def size(self):
-        return self.content.size()
+        if self._data is None and self._source is not None:
+            return self._source[2]
+        return len(self.data)
+
+    @property
+    def content_hash(self) -> bytes:
+        if self._content_hash is None:
+            self._content_hash = md5(self.data).digest()
+        return self._content_hash
 
     @property
     def checksum(self):
         if self._checksum is None:
-            self._checksum = calculate_hash(self.padded_data)
+            self._checksum = file_blocks.checksum(self.content_hash, self.data)
         return self._checksum
 
+    @property
+    def deflated(self) -> tuple[int, bytes]:
+        return file_blocks.deflate(self.content_hash, self.data)
+
+    @property
+    def padded_size(self):
+        return (self.size + 3) & ~3
+
     @property
     def padded_data(self) -> bytes:
-        data = self.data
+        data = bytes(self.data)
         if len(data) % 4 != 0:
             data += b"\x00" * (4 - (len(data) % 4))
         return data
 
     @property
     def header_format(self) -> bytes:
-        data = BinaryReader(bytearray())
-        data.write_int8(len(str(self.trove_path)))
-        data.write_str(str(self.trove_path))
-        data.extend(WriteLeb128(self.index))
-        data.extend(WriteLeb128(self.offset))
-        data.extend(WriteLeb128(self.size))
-        data.extend(WriteLeb128(self.checksum))
-        return data.buffer()
+        return EncodeFileTableEntry(
+            str(self.trove_path), self.index, self.offset, self.size, self.checksum
+        )
 
 
 class TroveMod:
@@ -121,6 +188,8 @@ class TroveMod:
     _tmod_hash: str = None
     _zip_content: bytes = None
     _tmod_content: bytes = None
+    # Set while the mod is unchanged from the file it was read from.
+    _source_path: Optional[Path] = None
     enabled: bool = True
     name_conflicts: list[TroveMod]
     file_conflicts: list[TroveMod]
@@ -164,23 +233,26 @@ class TroveMod:
         self.mod_path = new_mod_path
 
     def check_conflicts(self, mods: list[TroveMod]):
-        self.conflicts.clear()
+        self.name_conflicts.clear()
+        self.file_conflicts.clear()
+        paths = self.conflict_paths
         for mod in mods:
             if mod == self:
                 continue
             if mod.name == self.name:
                 self.name_conflicts.append(mod)
-            for file in self.files:
-                if file.trove_path == self.preview_path:
-                    continue
-                for other_file in mod.files:
-                    if other_file.trove_path == mod.preview_path:
-                        continue
-                    if file.trove_path == other_file.trove_path:
-                        self.file_conflicts.append(mod)
-                        break
-                if mod in self.file_conflicts:
-                    break
+            if not paths.isdisjoint(mod.conflict_paths):
+                self.file_conflicts.append(mod)
+
+    @property
+    def conflict_paths(self) -> set[str]:
+        return {file.trove_path for file in self.files} - self.ignored_paths
+
+    @property
+    def ignored_paths(self) -> set[str]:
+        """Files that belong to the mod itself rather than replacing game files."""
+        preview_path = self.preview_path
+        return {preview_path} if preview_path else set()
 
     @property
     def conflicts(self):
@@ -251,20 +323,29 @@ class TroveMod:
 
     @property
     def preview_path(self):
-        return self.get_property_value("previewPath").lower()
+        value = self.get_property_value("previewPath")
+        if value:
+            return value.lower()
+        return None
 
     @preview_path.setter
     def preview_path(self, value: Path):
         self.add_property("previewPath", value.as_posix())
 
     @property
-    def image(self):
+    def preview_data(self) -> Optional[bytes]:
+        preview_path = self.preview_path
         for file in self.files:
-            if file.trove_path == self.preview_path:
-                return base64.b64encode(file.data).decode("utf-8")
-        return base64.b64encode(
-            open("assets/images/construction.png", "rb").read()
-        ).decode("utf-8")
+            if file.trove_path == preview_path:
+                return bytes(file.read())
+        return None
+
+    @property
+    def image(self):
+        data = self.preview_data
+        if data is None:
+            data = construction_image()
+        return base64.b64encode(data).decode("utf-8")
 
     @property
     def tags(self):
@@ -308,9 +389,10 @@ class TroveMod:
         for file in self.files:
             file.index = 0
             file.offset = offset
-            offset += len(file.padded_data)
+            offset += file.padded_size
 
     def reset_cache(self):
+        self._source_path = None
         self.zip_content = None
         self.zip_hash = None
         self.tmod_content = None
@@ -332,51 +414,60 @@ class TroveMod:
         return metadata
 
     def compile_zip_mod(self) -> bytes:
-        if self.zip_content:
-            return self.zip_content
-        if not self.files:
-            raise NoFilesError("No files to compile")
-        metadata = self.pre_compile()
+        if self._zip_content is not None:
+            return self._zip_content
         data = io.BytesIO()
-        with zipfile.ZipFile(data, "w", zipfile.ZIP_DEFLATED) as f:
-            for file in self.files:
-                f.writestr(str(file.trove_path), file.data)
-            f.writestr(str("metadata.toml"), bytes(metadata, "utf-8"))
+        self.write_zip_mod(data)
         return data.getvalue()
 
+    def write_zip_mod(self, fp):
+        if not self.files:
+            raise NoFilesError("No files to compile")
+        metadata = bytes(self.pre_compile(), "utf-8")
+        blocks = file_blocks.deflate_many(
+            [(file.content_hash, file.data) for file in self.files]
+        )
+        entries = [
+            (str(file.trove_path), crc, file.size, deflated)
+            for file, (crc, deflated) in zip(self.files, blocks)
+        ]
+        crc, deflated = deflate_raw(metadata)
+        entries.append(("metadata.toml", crc, len(metadata), deflated))
+        write_zip(fp, entries)
+
     def compile_tmod(self) -> bytes:
+        return b"".join(self.iter_tmod())
+
+    def write_tmod(self, fp):
+        for block in self.iter_tmod():
+            fp.write(block)
+
+    def iter_tmod(self):
         if not self.files:
             raise NoFilesError("No files to compile")
         self.reorder_files()
-        tmod = BinaryReader(bytearray())
-        header_stream = BinaryReader(bytearray())
-        properties_stream = BinaryReader(bytearray())
-        files_list_stream = BinaryReader(bytearray())
-        file_stream = BinaryReader(bytearray())
-        for prop in self.properties:
-            properties_stream.write_bytes(WriteLeb128(len(prop.name)))
-            properties_stream.write_str(prop.name)
-            properties_stream.write_bytes(WriteLeb128(len(prop.value)))
-            properties_stream.write_str(prop.value)
+        yield self.tmod_header()
+        yield from compress_stream(self.iter_file_stream())
+
+    def tmod_header(self) -> bytes:
+        properties = EncodeProperties((p.name, p.value) for p in self.properties)
+        files_list = b"".join(file.header_format for file in reversed(self.files))
+        header_size = 12 + len(properties) + len(files_list)
+        return b"".join(
+            [
+                header_size.to_bytes(8, "little"),
+                self.version.to_bytes(2, "little"),
+                len(self.properties).to_bytes(2, "little"),
+                properties,
+                files_list,
+            ]
+        )
+
+    def iter_file_stream(self):
         for file in self.files:
-            file_stream.extend(bytearray(file.padded_data))
-        compressor = zlib.compressobj(level=0, strategy=0, wbits=zlib.MAX_WBITS)
-        chunked_file_stream = chunks(file_stream.buffer(), 32768)
-        file_stream = BinaryReader(bytearray())
-        for chunk in chunked_file_stream:
-            file_stream.extend(bytearray(compressor.compress(chunk)))
-        file_stream.extend(bytearray(compressor.flush(zlib.Z_SYNC_FLUSH)))
-        for i, file in enumerate(reversed(self.files), 1):
-            files_list_stream.extend(bytearray(file.header_format))
-        header_stream.write_uint64(0)
-        header_stream.write_uint16(self.version)
-        header_stream.write_uint16(len(self.properties))
-        header_stream.extend(properties_stream.buffer())
-        header_stream.extend(files_list_stream.buffer())
-        header_stream.seek(0)
-        header_stream.write_uint64(len(header_stream.buffer()))
-        tmod.extend(header_stream.buffer() + file_stream.buffer())
-        return tmod.buffer()
+            yield file.data
+            if padding := file.padded_size - file.size:
+                yield b"\x00" * padding
 
     @property
     def zip_content(self):
@@ -401,7 +492,7 @@ class TroveMod:
     @property
     def zip_hash(self):
         if self._zip_hash is None:
-            self.zip_hash = md5(self.compile_zip_mod()).hexdigest()
+            self.zip_hash = md5(self.zip_content).hexdigest()
         return self._zip_hash
 
     @zip_hash.setter
@@ -411,7 +502,7 @@ class TroveMod:
     @property
     def tmod_hash(self):
         if self._tmod_hash is None:
-            self.tmod_hash = md5(self.compile_tmod()).hexdigest()
+            self.tmod_hash = md5(self.tmod_content).hexdigest()
         return self._tmod_hash
 
     @tmod_hash.setter
@@ -428,80 +519,276 @@ class TroveMod:
 
 
 class TMod(TroveMod):
+    payload: Optional[TModPayload] = None
+
     def __str__(self):
         return f'<TMod "{self.name}">'
 
     @property
     def hash(self):
+        # The md5 of the source file, a recompile can order the file table differently.
+        if self._tmod_hash is None and self._source_path is not None:
+            self.tmod_hash = file_md5(self._source_path)
         return self.tmod_hash
 
     @classmethod
     def read_bytes(cls, path: Path, data: bytes):
         mod = cls()
         mod.tmod_content = data
+        mod.tmod_hash = md5(data).hexdigest()
         mod.mod_path = path
-        mod.files = []
-        data = BinaryReader(bytearray(data))
-        header_size = data.read_uint64()
-        mod.version = data.read_uint16()
-        properties_count = data.read_uint16()
-        mod.properties = []
-        for i in range(properties_count):
-            name_size = ReadLeb128(data, data.pos())
-            name = data.read_str(name_size)
-            value_size = ReadLeb128(data, data.pos())
-            value = data.read_str(value_size)
-            mod.properties.append(Property(name=name, value=value))
-        file_stream = data.buffer()[header_size:]
-        decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS)
-        try:
-            file_stream = BinaryReader(bytearray(decompressor.decompress(file_stream)))
-        except:
-            print("Failed to decompile mod, trying manual decompression: " + str(path))
-            file_stream = BinaryReader(bytearray(mod.manual_decompression(file_stream)))
-        while data.pos() < header_size:
-            name_size = data.read_uint8()
-            name = data.read_str(name_size)
-            index = ReadLeb128(data, data.pos())
-            offset = ReadLeb128(data, data.pos())
-            size = ReadLeb128(data, data.pos())
-            checksum = ReadLeb128(data, data.pos())
-            file_stream.seek(offset)
-            content = file_stream.read_bytes(size)
-            file = TroveModFile(path, Path(name), content)
+        mod._read(data)
+        return mod
+
+    @classmethod
+    def read_file(cls, path: Path):
+        mod = cls()
+        mod.mod_path = path
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                mod.tmod_hash = md5(data).hexdigest()
+                mod._read(data)
+        return mod
+
+    @classmethod
+    def read_header(cls, path: Path):
+        mod = cls()
+        mod.mod_path = path
+        with open(path, "rb") as f:
+            header_size = int.from_bytes(f.read(8), "little")
+            f.seek(0)
+            header = f.read(header_size)
+        entries = mod._read_header(header)
+        mod._add_lazy_files(TModPayload(mod, header_size), entries)
+        mod._source_path = path
+        return mod
+
+    @classmethod
+    def from_scan_entry(cls, path: Path, entry: dict):
+        mod = cls()
+        mod.mod_path = path
+        mod.version = entry["version"]
+        mod.properties = [
+            Property(name=name, value=value) for name, value in entry["properties"]
+        ]
+        mod._add_lazy_files(TModPayload(mod, entry["header_size"]), entry["files"])
+        mod.tmod_hash = entry.get("hash")
+        mod._source_path = path
+        return mod
+
+    @property
+    def scan_entry(self) -> dict:
+        return {
+            "format": "TMod",
+            "header_size": self.payload.offset,
+            "version": self.version,
+            "properties": [[prop.name, prop.value] for prop in self.properties],
+            "files": [
+                [
+                    file.trove_path,
+                    file.index,
+                    file._source[1],
+                    file.size,
+                    file.old_checksum,
+                ]
+                for file in self.files
+            ],
+        }
+
+    def _add_lazy_files(self, payload: TModPayload, entries):
+        self.payload = payload
+        self.files = []
+        for name, index, offset, size, checksum in entries:
+            file = TroveModFile.from_payload(
+                self.mod_path, Path(name), payload, offset, size
+            )
             file.index = index
             file.old_checksum = checksum
-            mod.files.append(file)
-        return mod
+            self.files.append(file)
+
+    def _read_header(self, data):
+        header_size = int.from_bytes(data[:8], "little")
+        self.version = int.from_bytes(data[8:10], "little")
+        properties_count = int.from_bytes(data[10:12], "little")
+        properties, pos = DecodeProperties(data, 12, properties_count)
+        entries, _ = DecodeFileTable(data, pos, header_size)
+        self.properties = [
+            Property(name=name, value=value) for name, value in properties
+        ]
+        return entries
+
+    def _read(self, data):
+        with memoryview(data) as view:
+            header_size = int.from_bytes(view[:8], "little")
+            entries = self._read_header(view)
+            with view[header_size:] as file_stream:
+                payload = memoryview(self.decompress_payload(file_stream))
+        self.files = []
+        for name, index, offset, size, checksum in entries:
+            file = TroveModFile(
+                self.mod_path, Path(name), payload[offset : offset + size]
+            )
+            file.index = index
+            file.old_checksum = checksum
+            self.files.append(file)
+
+    def decompress_payload(self, data):
+        try:
+            return self.manual_decompression(data)
+        except ValueError:
+            pass
+        decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS)
+        try:
+            return decompressor.decompress(data)
+        except zlib.error:
+            print(
+                "Failed to decompile mod, trying manual decompression: "
+                + str(self.mod_path)
+            )
+            return DecodeStoredDeflate(data, strict=False)
 
     def manual_decompression(self, data: bytes):
-        data = BinaryReader(bytearray(data[7:-5]))
-        data_chunks = data.size() // (32768 + 5)
-        output = BinaryReader(bytearray())
-        for i in range(data_chunks):
-            output.extend(bytearray(data.read_bytes(32768)))
-            data.read_bytes(5)
-        output.extend(bytearray(data.read_bytes(data.size() - data.pos())))
-        return output.buffer()
+        return DecodeStoredDeflate(data)
 
     def manual_compression(self, data: bytes):
-        output = BinaryReader(bytearray())
-        output.write_bytes(b"\x78\x01\x00\x00\x80\xFF\x7F")
-        data_chunks = chunks(data, 32768)
-        for data_chunk in data_chunks:
-            output.write_bytes(data_chunk)
-            if len(data_chunk) == 32768:
-                output.write_bytes(b"\x00\x00\x80\xFF\x7F")
-        output.write_bytes(b"\x00\x00\x00\xFF\xFF")
-        return output.buffer()
+        return b"".join(compress_stream([data]))
+
+
+class TModPayload:
+    """Compressed file stream of a TMod on disk, only decompressed on demand."""
+
+    chunk_size = 65536
+
+    def __init__(self, mod: TMod, offset: int):
+        self.mod = mod
+        self.offset = offset
+        self._buffer = None
+        self._index = None
+
+    def __repr__(self):
+        return f'<TModPayload "{self.mod.mod_path}" loaded={self.is_loaded}>'
+
+    @property
+    def is_loaded(self):
+        return self._buffer is not None
+
+    @property
+    def buffer(self) -> memoryview:
+        if self._buffer is None:
+            with open(self.mod.mod_path, "rb") as f:
+                f.seek(self.offset)
+                data = f.read()
+            self._buffer = memoryview(self.mod.decompress_payload(data))
+        return self._buffer
+
+    @property
+    def index(self) -> Optional[StoredBlockIndex]:
+        if self._index is None:
+            try:
+                with open(self.mod.mod_path, "rb") as f:
+                    self._index = StoredBlockIndex.from_file(f, self.offset)
+            except ValueError:
+                self._index = False
+        return self._index or None
+
+    def load(self, offset: int, size: int) -> memoryview:
+        return self.buffer[offset : offset + size]
+
+    def read_range(self, offset: int, size: int) -> bytes | memoryview:
+        if self._buffer is not None:
+            return self._buffer[offset : offset + size]
+        if self.index is not None:
+            with open(self.mod.mod_path, "rb") as f:
+                return self.index.read_range(f, offset, size)
+        end = offset + size
+        decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS)
+        output = bytearray()
+        produced = 0
+        try:
+            with open(self.mod.mod_path, "rb") as f:
+                f.seek(self.offset)
+                while produced < end:
+                    chunk = f.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    data = decompressor.decompress(chunk)
+                    if produced + len(data) > offset:
+                        output += data[max(offset - produced, 0) :]
+                    produced += len(data)
+        except zlib.error:
+            return self.buffer[offset:end]
+        return bytes(output[:size])
+
+
+class ZModPayload:
+    """Zip archive of a ZMod on disk, only read on demand."""
+
+    def __init__(self, mod: ZMod):
+        self.mod = mod
+        self._files = None
+
+    def __repr__(self):
+        return f'<ZModPayload "{self.mod.mod_path}" loaded={self.is_loaded}>'
+
+    @property
+    def is_loaded(self):
+        return self._files is not None
+
+    def load(self, name: str, size: int) -> bytes:
+        if self._files is None:
+            with zipfile.ZipFile(self.mod.mod_path) as f:
+                self._files = {
+                    info.filename: f.read(info)
+                    for info in f.infolist()
+                    if not info.is_dir()
+                }
+        return self._files[name]
+
+    def read_range(self, name: str, size: int) -> bytes:
+        if self._files is not None:
+            return self._files[name]
+        with zipfile.ZipFile(self.mod.mod_path) as f:
+            return f.read(name)
 
 
 class ZMod(TroveMod):
+    _entries: list[tuple[str, int]]
+    _metadata_read: bool = False
+    _metadata_preview_path: Optional[str] = None
+
     def __str__(self):
         return f'<ZMod "{self.name}">'
 
+    @property
+    def preview_path(self):
+        value = TroveMod.preview_path.fget(self)
+        if value:
+            return value
+        # Reading metadata.toml reopens the zip, conflict checks ask for it a lot.
+        if not self._metadata_read:
+            self._metadata_preview_path = None
+            for file in self.files:
+                if file.trove_path == "metadata.toml":
+                    self._metadata_preview_path = zip_preview_path(file.read())
+            self._metadata_read = True
+        return self._metadata_preview_path
+
+    @preview_path.setter
+    def preview_path(self, value: Path):
+        TroveMod.preview_path.fset(self, value)
+
+    @property
+    def ignored_paths(self) -> set[str]:
+        return super().ignored_paths | {"metadata.toml"}
+
+    def reset_cache(self):
+        super().reset_cache()
+        self._metadata_read = False
+
     @property
     def hash(self):
+        if self._zip_hash is None and self._source_path is not None:
+            self.zip_hash = file_md5(self._source_path)
         return self.zip_hash
 
     @classmethod
@@ -518,20 +805,349 @@ class ZMod(TroveMod):
         mod.name = path.stem
         return mod
 
+    @classmethod
+    def read_file(cls, path: Path):
+        return cls.read_bytes(path, BytesIO(path.read_bytes()))
+
+    @classmethod
+    def read_header(cls, path: Path):
+        mod = cls()
+        mod.mod_path = path
+        with zipfile.ZipFile(path) as f:
+            infos = [info for info in f.infolist() if not info.is_dir()]
+        mod._add_lazy_files([(info.filename, info.file_size) for info in infos])
+        for file, info in zip(mod.files, infos):
+            file.crc32 = info.CRC
+        mod.name = path.stem
+        mod._source_path = path
+        return mod
+
+    @classmethod
+    def from_scan_entry(cls, path: Path, entry: dict):
+        mod = cls()
+        mod.mod_path = path
+        mod._add_lazy_files(entry["files"])
+        mod.name = path.stem
+        mod.zip_hash = entry.get("hash")
+        mod._source_path = path
+        mod._metadata_preview_path = entry["preview_path"]
+        mod._metadata_read = True
+        return mod
+
+    @property
+    def scan_entry(self) -> dict:
+        return {
+            "format": "ZMod",
+            "files": [[name, size] for name, size in self._entries],
+            "preview_path": self.preview_path,
+        }
+
+    def _add_lazy_files(self, entries):
+        payload = ZModPayload(self)
+        self._entries = entries
+        self.files = [
+            TroveModFile.from_payload(self.mod_path, Path(name), payload, name, size)
+            for name, size in entries
+        ]
+
+
+class ModScanCache:
+    """Parsed headers of the mods in a folder, reused while files are unchanged."""
+
+    file_name = ".mods_cache.json"
+    version = 2
+
+    def __init__(self, path: Path):
+        self.path = path.joinpath(self.file_name)
+        self.entries = {}
+        self.seen = set()
+        self.changed = False
+        self.load()
+
+    def __str__(self):
+        return f'<ModScanCache "{self.path}" entries={len(self.entries)}>'
+
+    def __repr__(self):
+        return str(self)
+
+    def load(self):
+        self.entries = {}
+        try:
+            data = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return
+        if data.get("version") == self.version:
+            self.entries = data["mods"]
+
+    def save(self):
+        if not self.changed or not self.path.parent.exists():
+            return
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        temp_path.write_text(
+            json.dumps({"version": self.version, "mods": self.entries})
+        )
+        temp_path.replace(self.path)
+        self.changed = False
+
+    def read_mod(self, cls: type[TMod] | type[ZMod], path: Path) -> TroveMod:
+        return self.read_mods([(cls, path)])[0]
+
+    def read_mods(
+        self,
+        files: list[tuple[type[TMod] | type[ZMod], Path]],
+        workers: Optional[int] = None,
+    ) -> list[TroveMod]:
+        mods = [None] * len(files)
+        missing = []
+        for i, (cls, path) in enumerate(files):
+            self.seen.add(path.name)
+            stat = path.stat()
+            entry = self.entries.get(path.name)
+            if (
+                entry is not None
+                and entry["format"] == cls.__name__
+                and entry["size"] == stat.st_size
+                and entry["mtime"] == stat.st_mtime_ns
+            ):
+                mods[i] = cls.from_scan_entry(path, entry)
+            else:
+                missing.append(i)
+        classes = [files[i][0] for i in missing]
+        paths = [files[i][1] for i in missing]
+        if workers and len(missing) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                entries = list(executor.map(scan_mod_file, classes, paths, chunksize=8))
+        else:
+            entries = map(scan_mod_file, classes, paths)
+        for i, entry in zip(missing, entries):
+            cls, path = files[i]
+            self.entries[path.name] = entry
+            self.changed = True
+            mods[i] = cls.from_scan_entry(path, entry)
+        return mods
+
+    def prune(self):
+        for name in list(self.entries):
+            if name not in self.seen:
+                del self.entries[name]
+                self.changed = True
+        self.seen.clear()
+
+
+def scan_mod_file(cls: type[TMod] | type[ZMod], path: Path) -> dict:
+    stat = path.stat()
+    mod = cls.read_header(path)
+    return {
+        **mod.scan_entry,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "hash": file_md5(path),
+    }
+
+
+def verify_mod_data(data: bytes) -> dict:
+    """Fully decodes a mod and checks every file against its stored checksum."""
+    # Sniffed from the content, some mods are listed with the wrong format.
+    format = "zip" if data[:4] in (b"PK\x03\x04", b"PK\x05\x06") else "tmod"
+    result = {
+        "valid": False,
+        "format": format,
+        "file_count": 0,
+        "uncompressed_size": 0,
+        "errors": [],
+    }
+    errors = result["errors"]
+    try:
+        if format == "zip":
+            with zipfile.ZipFile(io.BytesIO(data)) as f:
+                infos = [info for info in f.infolist() if not info.is_dir()]
+                corrupt = f.testzip()
+            if corrupt is not None:
+                errors.append(f"CRC mismatch for {corrupt}")
+            sizes = [info.file_size for info in infos]
+        else:
+            mod = TMod()
+            view = memoryview(data)
+            header_size = int.from_bytes(view[:8], "little")
+            if len(view) < 12 or not 12 <= header_size <= len(view):
+                raise ValueError("Header is truncated")
+            entries = mod._read_header(view)
+            try:
+                payload = DecodeStoredDeflate(view[header_size:])
+            except ValueError:
+                payload = zlib.decompressobj().decompress(view[header_size:])
+            payload = memoryview(payload)
+            sizes = []
+            for name, _, offset, size, checksum in entries:
+                sizes.append(size)
+                if offset + size > len(payload):
+                    errors.append(f"{name} is outside of the payload")
+                    continue
+                file = TroveModFile(Path(), Path(name), payload[offset : offset + size])
+                # Some tools write 0 as the checksum, others hash the unpadded bytes.
+                if checksum and checksum not in (
+                    file.checksum,
+                    calculate_hash(file.data),
+                ):
+                    errors.append(f"Checksum mismatch for {name}")
+    except (
+        ValueError,
+        IndexError,
+        UnicodeDecodeError,
+        zlib.error,
+        zipfile.BadZipFile,
+    ) as e:
+        errors.append(f"Failed to decode mod: {e}")
+        return result
+    result["file_count"] = len(sizes)
+    result["uncompressed_size"] = sum(sizes)
+    result["valid"] = not errors
+    return result
+
+
+def verify_mod_file(path: Path) -> dict:
+    return verify_mod_data(path.read_bytes())
+
+
+class ConflictReport:
+    names: dict[str, list[TroveMod]]
+    files: dict[str, list[TroveMod]]
+
+    def __init__(
+        self, names: dict[str, list[TroveMod]], files: dict[str, list[TroveMod]]
+    ):
+        self.names = names
+        self.files = files
+
+    def __str__(self):
+        return f"<ConflictReport names={len(self.names)} files={len(self.files)}>"
+
+    def __repr__(self):
+        return str(self)
+
+    def __bool__(self):
+        return bool(self.names or self.files)
+
+    @property
+    def mods(self) -> list[TroveMod]:
+        mods = {}
+        for conflicting in [*self.names.values(), *self.files.values()]:
+            for mod in conflicting:
+                mods[id(mod)] = mod
+        return list(mods.values())
+
+    def get_mod_conflicts(self, mod: TroveMod) -> dict[str, list[TroveMod]]:
+        return {
+            path: [other for other in mods if other is not mod]
+            for path, mods in self.files.items()
+            if any(other is mod for other in mods)
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            "names": {
+                name: [str(mod.mod_path) for mod in mods]
+                for name, mods in self.names.items()
+            },
+            "files": {
+                path: [str(mod.mod_path) for mod in mods]
+                for path, mods in self.files.items()
+            },
+        }
+
+
+class ModDiff:
+    added: list[str]
+    removed: list[str]
+    changed: list[str]
+    unchanged: int
+
+    def __init__(
+        self, added: list[str], removed: list[str], changed: list[str], unchanged: int
+    ):
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+        self.unchanged = unchanged
+
+    def __str__(self):
+        return (
+            f"<ModDiff added={len(self.added)} removed={len(self.removed)}"
+            f" changed={len(self.changed)}>"
+        )
+
+    def __repr__(self):
+        return str(self)
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    @classmethod
+    def compare(cls, old: TroveMod, new: TroveMod) -> ModDiff:
+        old_ignored, new_ignored = old.ignored_paths, new.ignored_paths
+        old_files = {
+            file.trove_path: file
+            for file in old.files
+            if file.trove_path not in old_ignored
+        }
+        new_files = {
+            file.trove_path: file
+            for file in new.files
+            if file.trove_path not in new_ignored
+        }
+        changed = []
+        unchanged = 0
+        for path in sorted(old_files.keys() & new_files.keys()):
+            if cls.files_differ(old_files[path], new_files[path]):
+                changed.append(path)
+            else:
+                unchanged += 1
+        return cls(
+            sorted(new_files.keys() - old_files.keys()),
+            sorted(old_files.keys() - new_files.keys()),
+            changed,
+            unchanged,
+        )
+
+    @staticmethod
+    def files_differ(old: TroveModFile, new: TroveModFile) -> bool:
+        if old.size != new.size:
+            return True
+        # Header checksums can be 0 or hash the unpadded bytes, only a match is trusted.
+        if old.old_checksum and old.old_checksum == new.old_checksum:
+            return False
+        if old.crc32 is not None and new.crc32 is not None:
+            return old.crc32 != new.crc32
+        return old.checksum != new.checksum
+
+    def to_dict(self) -> dict:
+        return {
+            "added": self.added,
+            "removed": self.removed,
+            "changed": self.changed,
+            "unchanged": self.unchanged,
+        }
+
 
 class TroveModList:
     enabled: list[TroveMod]
     disabled: list[TroveMod]
     _mods: list[TroveMod]
+    path_index: dict[str, list[TroveMod]]
+    conflict_report: ConflictReport
 
-    def __init__(self, path: Path):
+    def __init__(self, path: Path, workers: Optional[int] = None):
         self.enabled = []
         self.disabled = []
         self._mods = []
+        self.workers = workers
+        self.path_index = {}
+        self.conflict_report = ConflictReport({}, {})
         self.installation_path = path
         self.list_path = path.joinpath("mods")
         if self.installation_path.exists():
             self.list_path.mkdir(parents=True, exist_ok=True)
+        self.scan_cache = ModScanCache(self.list_path)
         self._populate()
 
     def __str__(self):
@@ -595,109 +1211,254 @@ class TroveModList:
     def _populate(self):
         self.enabled.clear()
         self.disabled.clear()
-        self._populate_tmod_enabled()
-        self._populate_tmod_disabled()
-        self._populate_zip_enabled()
-        self._populate_zip_disabled()
+        files = [
+            *self._populate_tmod_enabled(),
+            *self._populate_tmod_disabled(),
+            *self._populate_zip_enabled(),
+            *self._populate_zip_disabled(),
+        ]
+        mods = self.scan_cache.read_mods(
+            [(cls, path) for cls, path, _ in files], self.workers
+        )
+        for mod, (_, _, enabled) in zip(mods, files):
+            if isinstance(mod, TMod) and mod.has_wrong_name:
+                mod.fix_name()
+            mod.enabled = enabled
+            if enabled:
+                self.enabled.append(mod)
+            else:
+                self.disabled.append(mod)
+        self.scan_cache.prune()
+        self.scan_cache.save()
+        self._mods = self.enabled + self.disabled
         self.sort_by_name()
+        self.check_conflicts()
+
+    def check_conflicts(self):
+        names = {}
+        paths = {}
+        for mod in self.mods:
+            mod.name_conflicts.clear()
+            mod.file_conflicts.clear()
+            names.setdefault(mod.name, []).append(mod)
+            for path in mod.conflict_paths:
+                paths.setdefault(path, []).append(mod)
+        self.path_index = paths
+        self.conflict_report = ConflictReport(
+            {name: mods for name, mods in names.items() if len(mods) > 1},
+            {path: mods for path, mods in paths.items() if len(mods) > 1},
+        )
+        for mods in self.conflict_report.names.values():
+            for mod in mods:
+                mod.name_conflicts.extend(other for other in mods if other is not mod)
+        file_conflicts = {}
+        for mods in self.conflict_report.files.values():
+            for mod in mods:
+                file_conflicts.setdefault(id(mod), set()).update(map(id, mods))
         for mod in self.mods:
-            mod.check_conflicts(self.mods)
+            conflicting = file_conflicts.get(id(mod), ())
+            mod.file_conflicts.extend(
+                other
+                for other in self.mods
+                if other is not mod and id(other) in conflicting
+            )
 
     def _populate_tmod_enabled(self):
-        for file in self.list_path.glob("*.tmod"):
-            file_data = file.read_bytes()
-            mod = TMod.read_bytes(file, file_data)
-            if mod.has_wrong_name:
-                mod.fix_name()
-            self.enabled.append(mod)
+        return [(TMod, file, True) for file in self.list_path.glob("*.tmod")]
 
     def _populate_tmod_disabled(self):
-        for file in self.list_path.glob("*.tmod.disabled"):
-            file_data = file.read_bytes()
-            mod = TMod.read_bytes(file, file_data)
-            if mod.has_wrong_name:
-                mod.fix_name()
-            mod.enabled = False
-            self.disabled.append(mod)
+        return [(TMod, file, False) for file in self.list_path.glob("*.tmod.disabled")]
 
     def _populate_zip_enabled(self):
-        for file in self.list_path.glob("*.zip"):
-            file_data = file.read_bytes()
-            mod = ZMod.read_bytes(file, BytesIO(file_data))
-            self.enabled.append(mod)
+        return [(ZMod, file, True) for file in self.list_path.glob("*.zip")]
 
     def _populate_zip_disabled(self):
-        for file in self.list_path.glob("*.zip.disabled"):
-            file_data = file.read_bytes()
-            mod = ZMod.read_bytes(file, BytesIO(file_data))
-            mod.enabled = False
-            self.disabled.append(mod)
+        return [(ZMod, file, False) for file in self.list_path.glob("*.zip.disabled")]
+
+
+class TPackPayload:
+    """Compressed mod stream of a TPack, read one mod at a time."""
+
+    def __init__(self, pack: TPack, offset: int, data: bytes = None):
+        self.pack = pack
+        self.offset = offset
+        self.data = data
+        self._index = None
+        self._buffer = None
+
+    def __repr__(self):
+        return f'<TPackPayload "{self.pack.mod_path}" offset={self.offset}>'
+
+    def _open(self):
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        return open(self.pack.mod_path, "rb")
+
+    @property
+    def index(self) -> Optional[StoredBlockIndex]:
+        if self._index is None:
+            try:
+                with self._open() as f:
+                    self._index = StoredBlockIndex.from_file(f, self.offset)
+            except ValueError:
+                self._index = False
+        return self._index or None
+
+    @property
+    def buffer(self) -> memoryview:
+        if self._buffer is None:
+            with self._open() as f:
+                f.seek(self.offset)
+                data = f.read()
+            decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS)
+            self._buffer = memoryview(decompressor.decompress(data))
+        return self._buffer
+
+    def iter_range(self, offset: int, size: int):
+        if self._buffer is None and self.index is not None:
+            with self._open() as f:
+                yield from self.index.iter_range(f, offset, size)
+            return
+        # Not level 0 compressed, seeking needs the inflated stream.
+        yield self.buffer[offset : offset + size]
+
+    def read_range(self, offset: int, size: int) -> bytes:
+        return b"".join(self.iter_range(offset, size))
+
+
+class TPackEntry:
+    def __init__(self, pack: TPack, name: str, offset: int, size: int, checksum: int):
+        self.pack = pack
+        self.name = name
+        self.offset = offset
+        self.size = size
+        self.checksum = checksum
+
+    def __str__(self):
+        return f'<TPackEntry "{self.name}" ({self.size} bytes)>'
+
+    def __repr__(self):
+        return str(self)
+
+    def iter_data(self):
+        return self.pack.payload.iter_range(self.offset, self.size)
+
+    def read(self, verify: bool = True) -> bytes:
+        data = self.pack.payload.read_range(self.offset, self.size)
+        if verify and calculate_hash(data) != self.checksum:
+            raise ChecksumMismatchError(f"Checksum mismatch for {self.name}")
+        return data
+
+    def extract(self, path: Path, verify: bool = True) -> Path:
+        temp_path = path.with_name(path.name + ".tmp")
+        checksum = TroveHash()
+        with open(temp_path, "wb") as f:
+            for chunk in self.iter_data():
+                checksum.update(chunk)
+                f.write(chunk)
+        if verify and checksum.digest() != self.checksum:
+            temp_path.unlink()
+            raise ChecksumMismatchError(f"Checksum mismatch for {self.name}")
+        temp_path.replace(path)
+        return path
+
+    def to_mod(self, verify: bool = True) -> TMod:
+        return TMod.read_bytes(Path(self.name), self.read(verify))
 
 
 class TPack:
+    mod_path: Path = None
+    version: int = 1
     properties: list[Property]
     files: list[TroveMod]
+    entries: list[TPackEntry]
+    payload: Optional[TPackPayload] = None
 
     def __init__(self):
         self.properties = []
         self.files = []
+        self.entries = []
 
     def compile(self):
-        pack = BinaryReader(bytearray())
-        file_stream = BinaryReader(bytearray())
-        pack.write_uint64(0)
-        pack.write_uint16(1)
-        pack.write_uint16(len(self.properties))
-        for prop in self.properties:
-            pack.write_bytes(WriteLeb128(len(prop.name)))
-            pack.write_str(prop.name)
-            pack.write_bytes(WriteLeb128(len(prop.value)))
-            pack.write_str(prop.value)
-        offset = 0
-        for file in self.files:
-            mod_data = file.mod_path.read_bytes()
-            pack.write_int8(len(file.mod_path.name))
-            pack.write_str(file.mod_path.name)
-            pack.write_bytes(WriteLeb128(0))
-            pack.write_bytes(WriteLeb128(0))
-            pack.write_bytes(WriteLeb128(offset))
-            pack.write_bytes(WriteLeb128(len(mod_data)))
-            pack.write_bytes(WriteLeb128(calculate_hash(mod_data)))
-            offset += len(mod_data)
-            file_stream.write_bytes(mod_data)
-        pack.seek(0)
-        pack.write_uint64(pack.size())
-        compressor = zlib.compressobj(level=0, strategy=0, wbits=zlib.MAX_WBITS)
-        chunked_file_stream = chunks(file_stream.buffer(), 32768)
-        file_stream = BinaryReader(bytearray())
-        for chunk in chunked_file_stream:
-            file_stream.extend(bytearray(compressor.compress(chunk)))
-        file_stream.extend(bytearray(compressor.flush(zlib.Z_SYNC_FLUSH)))
-        pack.extend(file_stream.buffer())
-        return pack.buffer()
+        return b"".join(self.iter_compile())
+
+    def write(self, fp):
+        for block in self.iter_compile():
+            fp.write(block)
+
+    def iter_compile(self):
+        with ExitStack() as stack:
+            # Opened once for both passes, a cached mod trimmed meanwhile stays readable.
+            handles = [
+                stack.enter_context(open(file.mod_path, "rb")) for file in self.files
+            ]
+            entries = []
+            offset = 0
+            for file, f in zip(self.files, handles):
+                checksum = TroveHash()
+                size = 0
+                for chunk in iter(partial(f.read, 32768), b""):
+                    checksum.update(chunk)
+                    size += len(chunk)
+                f.seek(0)
+                entries.append(
+                    (file.mod_path.name, 0, 0, offset, size, checksum.digest())
+                )
+                offset += size
+            yield self.header(entries)
+            yield from compress_stream(
+                chunk for f in handles for chunk in iter(partial(f.read, 32768), b"")
+            )
+
+    def header(self, entries) -> bytes:
+        properties = EncodeProperties((p.name, p.value) for p in self.properties)
+        files_list = b"".join(EncodeFileTableEntry(*entry) for entry in entries)
+        header_size = 12 + len(properties) + len(files_list)
+        return b"".join(
+            [
+                header_size.to_bytes(8, "little"),
+                (1).to_bytes(2, "little"),
+                len(self.properties).to_bytes(2, "little"),
+                properties,
+                files_list,
+            ]
+        )
 
     @classmethod
     def parse(cls, path: Path, data):
         tpack = cls()
-        pack = BinaryReader(bytearray(data))
-        header_size = pack.read_uint64()
-        version = pack.read_uint16()
-        file_count = pack.read_uint16()
-        property_count = pack.read_uint16()
-        for _ in range(property_count):
-            name_length = ReadLeb128(pack)
-            name = pack.read_str(name_length)
-            value_length = ReadLeb128(pack)
-            value = pack.read_str(value_length)
-            tpack.add_property(name, value)
-        for _ in range(file_count):
-            file_name_length = pack.read_int8()
-            file_name = pack.read_str(file_name_length)
-            index = ReadLeb128(pack, pack.pos())
-            file_offset = ReadLeb128(pack, pack.pos())
-            file_size = ReadLeb128(pack, pack.pos())
-            file_hash = ReadLeb128(pack, pack.pos())
-            tpack.files.append(TroveMod(file_name, file_offset, file_size, file_hash))
+        tpack.mod_path = path
+        header_size = tpack._read_header(memoryview(data))
+        tpack.payload = TPackPayload(tpack, 0, bytes(data[header_size:]))
+        return tpack
+
+    @classmethod
+    def read_file(cls, path: Path):
+        tpack = cls()
+        tpack.mod_path = path
+        with open(path, "rb") as f:
+            header_size = int.from_bytes(f.read(8), "little")
+            f.seek(0)
+            tpack._read_header(memoryview(f.read(header_size)))
+        tpack.payload = TPackPayload(tpack, header_size)
+        return tpack
+
+    def _read_header(self, data) -> int:
+        header_size = int.from_bytes(data[:8], "little")
+        self.version = int.from_bytes(data[8:10], "little")
+        property_count = int.from_bytes(data[10:12], "little")
+        properties, pos = DecodeProperties(data, 12, property_count)
+        for name, value in properties:
+            self.add_property(name, value)
+        entries, _ = DecodeFileTable(data, pos, header_size, fields=5)
+        self.entries = [
+            TPackEntry(self, file_name, file_offset, file_size, file_hash)
+            for file_name, _, _, file_offset, file_size, file_hash in entries
+        ]
+        return header_size
+
+    def get_entry(self, name: str) -> Optional[TPackEntry]:
+        return get_attr(self.entries, name=name)
 
     @property
     def author(self):
@@ -726,6 +1487,15 @@ class ModEntry(Document):
     format: str
     authors: list[ModAuthor]
     description: Optional[str] = None
+    verified: bool = False
+    file_count: Optional[int] = None
+    uncompressed_size: Optional[int] = None
+
+    def set_verification(self, verification: dict):
+        self.format = verification["format"]
+        self.verified = verification["valid"]
+        self.file_count = verification["file_count"]
+        self.uncompressed_size = verification["uncompressed_size"]
 
 
 class SearchMod(Document):
@@ -1,9 +1,16 @@
-from quart import Blueprint, request, abort, current_app, send_file
-from .models.database.mod import ModEntry, ZMod, TMod, SearchMod
+from quart import Blueprint, Response, request, abort, current_app, send_file
+from .models.database.mod import ModDiff, ModEntry, TMod, ZMod, SearchMod
 from .utils.cache import SortOrder
+from .utils.mod_store import mod_store
+from .utils.previews import (
+    PreviewSize,
+    get_missing_path,
+    get_preview_path,
+    preview_pipeline,
+)
 from pathlib import Path
 from io import BytesIO
-import base64
+import asyncio
 import traceback
 import re
 from utils import render_json
@@ -31,7 +38,7 @@ async def get_mods():
         if not field:
             continue
         key, value = field.split("$")
-        fields.append((key, SortOrder(value)))
+        fields.append((key, SortOrder(int(value))))
     limit = int(params.get("limit", 0)) or None
     offset = int(params.get("offset", 0)) or None
     return render_json(
@@ -67,6 +74,46 @@ async def get_mod_by_hash(mod_hash):
     return render_json(current_app.mods_list.get_mod_by_hash(mod_hash))
 
 
+@mods.route("/conflicts", methods=["POST"])
+async def get_mods_conflicts():
+    if not hasattr(current_app, "mods_list"):
+        return abort(503, "Mods list is not populated.")
+    params = request.args
+    hashes = params.get("hashes", "").split("#")
+    hashes = [h for h in hashes if h]
+    if not hashes:
+        data = await request.get_json(silent=True)
+        hashes = data.get("hashes") if isinstance(data, dict) else None
+        if not isinstance(hashes, list) or not all(isinstance(h, str) for h in hashes):
+            return "Expected a JSON object with a list of hashes", 400
+    return render_json(current_app.mods_list.get_conflicts(hashes))
+
+
+@mods.route("/by_path", methods=["GET"])
+async def get_mods_by_path():
+    if not hasattr(current_app, "mods_list"):
+        return abort(503, "Mods list is not populated.")
+    path_index = getattr(current_app.mods_list, "path_index", None)
+    if path_index is None:
+        return abort(503, "Mods path index is not populated.")
+    params = request.args
+    path = params.get("path")
+    prefix = params.get("prefix")
+    if path:
+        return render_json(
+            {"path": path_index.normalize(path), "mods": path_index.get(path)}
+        )
+    if prefix:
+        try:
+            limit = min(int(params.get("limit", 100)), 1000)
+        except ValueError:
+            return "Limit must be a number", 400
+        if limit < 1:
+            return "Limit must be positive", 400
+        return render_json(path_index.get_prefix(prefix, limit=limit))
+    return "No path or prefix provided", 400
+
+
 @mods.route("/hashes", methods=["GET"])
 async def get_mods_by_hashes():
     if not hasattr(current_app, "mods_list"):
@@ -235,6 +282,48 @@ async def get_mod_sub_types(type):
     return render_json({})
 
 
+@mods.route("/diff/<hash_a>/<hash_b>", methods=["GET"])
+async def get_mods_diff(hash_a, hash_b):
+    mods = []
+    for hash in (hash_a, hash_b):
+        mod_entry = await ModEntry.find_one({"hash": hash})
+        if mod_entry is None:
+            return f"Mod {hash} not found", 404
+        mod_path = await asyncio.to_thread(mod_store.get_path, hash, mod_entry.format)
+        if mod_path is None:
+            return f"Mod file {hash} not found", 404
+        mod_class = ZMod if mod_entry.format.lower() == "zip" else TMod
+        mods.append(await asyncio.to_thread(mod_class.read_header, mod_path))
+    diff = await asyncio.to_thread(ModDiff.compare, *mods)
+    return render_json({"from": hash_a, "to": hash_b, **diff.to_dict()})
+
+
+@mods.route("/delta/<old_hash>/<new_hash>", methods=["GET"])
+async def get_mod_delta(old_hash, new_hash):
+    if not hasattr(current_app, "mods_list"):
+        return abort(503, "Mods list is not populated.")
+    mod = current_app.mods_list.get_trovesaurus_mod(new_hash)
+    if mod is None:
+        return "Mod not found", 404
+    if (old_hash, new_hash) not in [
+        (old.hash, new.hash) for old, new in mod.update_pairs
+    ]:
+        return "Hashes aren't consecutive versions of the same mod", 400
+    delta_path = await asyncio.to_thread(mod_store.get_delta_path, old_hash, new_hash)
+    if delta_path is None:
+        return "Mod file not found", 404
+    response = await send_file(
+        delta_path,
+        mimetype="application/zip",
+        attachment_filename=delta_path.name,
+        as_attachment=True,
+    )
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000
+    response.cache_control.immutable = True
+    return response
+
+
 @mods.route("/tmod_converter/<hash>", methods=["GET"])
 async def convert_tmod(hash):
     return "Not Implemented", 501
@@ -245,10 +334,10 @@ async def convert_tmod(hash):
         return "Mod not found", 404
     if mod_entry.format == "tmod":
         return "Mod is already in tmod format", 400
-    mod_path = mods_path / f"{hash}.{mod_entry.format}"
-    if not mod_path.exists():
+    mod_path = await asyncio.to_thread(mod_store.get_path, hash, mod_entry.format)
+    if mod_path is None:
         return "Mod file not found", 404
-    mod = ZMod.read_bytes(mod_path, BytesIO(mod_path.read_bytes()))
+    mod = ZMod.read_file(mod_path)
     mod.author = mod_entry.author
     mod.name = mod_entry.name
     mod.notes = mod_entry.description
@@ -263,29 +352,43 @@ async def convert_tmod(hash):
 async def get_preview_image(hash):
     if not hasattr(current_app, "mods_list"):
         return abort(503, "Mods list is not populated.")
-    cached_image_path = mods_path / f"cached_images/{hash}.png"
-    if cached_image_path.exists():
-        return await send_file(
-            cached_image_path, attachment_filename=f"{hash}.png", as_attachment=True
-        )
-    mod_entry = await ModEntry.find_one({"hash": hash})
-    if mod_entry is None:
-        return "Mod not found", 404
-    mod_path = mods_path / f"{hash}.{mod_entry.format}"
-    if not mod_path.exists():
-        return "Mod file not found", 404
     try:
-        mod = TMod.read_bytes(mod_path, mod_path.read_bytes())
-        image_data = base64.b64decode(mod.image)
-        image_path = mods_path / f"cached_images/{hash}.png"
-        image_path.write_bytes(image_data)
-        return await send_file(
-            BytesIO(), attachment_filename=f"{mod_entry.hash}.png", as_attachment=True
-        )
-    except Exception as e:
-        print(e)
-    return await send_file(
+        size = PreviewSize[request.args.get("size", "ORIGINAL").upper()]
+    except KeyError:
+        return abort(400, "Invalid size\nValid sizes: SMALL, MEDIUM, LARGE, ORIGINAL")
+    image_path = get_preview_path(hash, size)
+    if image_path.exists():
+        # Mod hashes never change content, neither do their previews.
+        etag = f"{hash}-{size.name.lower()}"
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            response = await send_file(
+                image_path, attachment_filename=f"{hash}.png", as_attachment=True
+            )
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+        return response
+    has_no_preview = get_missing_path(hash).exists()
+    if not has_no_preview:
+        mod_entry = await ModEntry.find_one({"hash": hash})
+        if mod_entry is None:
+            return "Mod not found", 404
+        format = mod_entry.format.lower()
+        if current_app.main_worker:
+            preview_pipeline.queue(
+                await asyncio.to_thread(preview_pipeline.missing, [(hash, format)])
+            )
+        else:
+            # Only the main worker runs a build pool, the others hand misses over.
+            await current_app.redis.publish("mod_previews", (hash, format))
+    response = await send_file(
         "assets/no_preview.png",
         attachment_filename="no_preview.png",
         as_attachment=True,
     )
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400 if has_no_preview else 60
+    return response
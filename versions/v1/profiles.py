@@ -1,16 +1,18 @@
 from .models.database.profile import ModProfile
-from .models.database.mod import TMod, ZMod, TPack, ModEntry
+from .models.database.mod import TMod, ZMod, TPack, ModEntry, verify_mod_data
 from .utils.trovesaurus import ModAuthor
 from quart import (
     Blueprint,
+    Response,
     request,
-    send_file,
     current_app,
 )
 from .utils.authorization import authorize
+from .utils.functions import iterate_in_thread
+from .utils.mod_store import mod_store
 from pathlib import Path
+import asyncio
 from base64 import b64decode
-from io import BytesIO
 from copy import deepcopy
 from utils import render_json
 
@@ -60,8 +62,20 @@ async def upload_cloud_mods():
         mod_bytes = b64decode(mod_data["data"])
         del mod_data["data"]
         entry = ModEntry(**mod_data)
-        mod_path = mods_path.joinpath(f"{entry.hash}.{entry.format}")
-        mod_path.write_bytes(mod_bytes)
+        result = await asyncio.to_thread(verify_mod_data, mod_bytes)
+        if not result["valid"]:
+            await asyncio.to_thread(
+                mod_store.quarantine,
+                entry.hash,
+                result["format"],
+                mod_bytes,
+                result["errors"],
+            )
+            continue
+        await asyncio.to_thread(
+            mod_store.add, entry.hash, result["format"], mod_bytes, result
+        )
+        entry.set_verification(result)
         await entry.save()
     return "OK", 200
 
@@ -362,22 +376,24 @@ async def download_profile(profile_id):
     mods = []
     for hash in profile.mod_hashes:
         mod_info = await ModEntry.find_one({"hash": hash})
-        mod_path = Path(f"mods/{hash}.{mod_info.format}")
-        if not mod_path.exists():
+        mod_path = await asyncio.to_thread(mod_store.get_path, hash, mod_info.format)
+        if mod_path is None:
             return (
                 'One of the mods wasn\'t found, please report this to "aallyn" on discord',
                 503,
             )
         if mod_info.format == "zip":
-            mod = ZMod.read_bytes(mod_path, BytesIO(mod_path.read_bytes()))
+            mod = ZMod()
+            mod.mod_path = mod_path
             mod.name = mod_info.name
         else:
-            mod = TMod.read_bytes(mod_path, mod_path.read_bytes())
+            mod = TMod.read_header(mod_path)
         mods.append(mod)
     pack = TPack()
     pack.author = "aallyn"
     pack.files.extend(mods)
-    data = pack.compile()
-    return await send_file(
-        BytesIO(data), as_attachment=True, attachment_filename=f"{profile_id}.tpack"
+    return Response(
+        iterate_in_thread(pack.iter_compile()),
+        mimetype="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="{profile_id}.tpack"'},
     )
@@ -2,144 +2,503 @@ from quart import current_app
 from ..utils import tasks
 from aiohttp import ClientSession
 from ..utils.trovesaurus import TrovesaurusMod
-from ..models.database.mod import ModEntry, SearchMod
+from ..models.database.mod import (
+    ModEntry,
+    SearchMod,
+    verify_mod_data,
+    verify_mod_file,
+)
 from ..utils.cache import ModCache
-from pathlib import Path
+from ..utils.mod_store import mod_store
+from ..utils.mod_downloader import mod_downloader
+from ..utils.previews import preview_pipeline
 import os
 import asyncio
 import traceback
 import time
+from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
+from functools import cache
+from pathlib import Path
 from hashlib import md5
+from aiohttp import ClientError
+from beanie import BulkWriter
 from ..utils.logger import l
 from datetime import datetime, UTC
 from json import loads, dumps
 from utils import Event, EventType
 
 
+# Download and verification futures by hash, shared by overlapping refreshes.
+pending_mods: dict[str, asyncio.Future] = {}
+database_lock = asyncio.Lock()
+# Held while a catalog is published so an older one can't be published after it.
+catalog_lock = asyncio.Lock()
+
+
+@cache
+def get_ingest_executor() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor()
+
+
+async def ingest_mod(mod_entry: ModEntry, path: Path) -> bool:
+    """Verifies a downloaded mod and stores it with the result in its manifest."""
+    result = await asyncio.get_running_loop().run_in_executor(
+        get_ingest_executor(), verify_mod_file, path
+    )
+    data = await asyncio.to_thread(path.read_bytes)
+    if not result["valid"]:
+        await quarantine_mod(mod_entry, result, data)
+        return False
+    await asyncio.to_thread(
+        mod_store.add, mod_entry.hash, result["format"], data, result
+    )
+    mod_entry.set_verification(result)
+    return True
+
+
+def verify_stored_data(hash: str) -> dict:
+    return verify_mod_data(mod_store.read(hash))
+
+
+async def verify_stored_mod(mod_entry: ModEntry) -> Optional[bool]:
+    """Verifies a mod stored before verification results were kept, e.g. migrated ones.
+
+    The mod is rebuilt from its segments in the worker, not through the file cache."""
+    if not await asyncio.to_thread(mod_store.__contains__, mod_entry.hash):
+        return None
+    result = await asyncio.get_running_loop().run_in_executor(
+        get_ingest_executor(), verify_stored_data, mod_entry.hash
+    )
+    if not result["valid"]:
+        data = await asyncio.to_thread(mod_store.read, mod_entry.hash)
+        await quarantine_mod(mod_entry, result, data)
+        await asyncio.to_thread(mod_store.remove, mod_entry.hash)
+        return False
+    await asyncio.to_thread(mod_store.set_verification, mod_entry.hash, result)
+    mod_entry.set_verification(result)
+    return True
+
+
+async def quarantine_mod(mod_entry: ModEntry, result: dict, data: bytes):
+    await asyncio.to_thread(
+        mod_store.quarantine,
+        mod_entry.hash,
+        result["format"],
+        data,
+        result["errors"],
+    )
+    l("Mod List").error(f"Quarantined {mod_entry.hash}: {'; '.join(result['errors'])}")
+
+
 @tasks.loop(seconds=5)
 async def update_mods_list():
     start = time.time()
     try:
         if not current_app.main_worker:
-            mod_cache = await current_app.redis.get_object("mods_cache")
-            if mod_cache is not None and (
-                not hasattr(current_app, "mods_list_updated")
-                or await current_app.redis.get_value("mods_cache_updated")
-                != current_app.mods_list_updated
-            ):
-                current_app.mods_list = mod_cache
-                current_app.mods_list_updated = await current_app.redis.get_value(
-                    "mods_cache_updated"
+            # Subscribe before catching up so no version published in between is missed.
+            pubsub = await current_app.redis.subscribe("mods_catalog")
+            try:
+                version = await current_app.redis.get_value("mods_catalog_version")
+                if version is not None:
+                    await sync_mods_catalog(version)
+                async for version in current_app.redis.listen(pubsub):
+                    await sync_mods_catalog(version)
+            finally:
+                await pubsub.aclose()
+        else:
+            token = os.getenv("TROVESAURUS_TOKEN")
+            fetch_state = getattr(current_app, "mods_fetch_state", {})
+            async with ClientSession() as session:
+                hot_state = await fetch_if_changed(
+                    session,
+                    f"https://trovesaurus.com/mods/api/hot?token={token}",
+                    fetch_state.get("hot"),
                 )
+                list_state = await fetch_if_changed(
+                    session,
+                    f"https://trovesaurus.com/mods/api/list?token={token}",
+                    fetch_state.get("list"),
+                )
+            if hot_state is None and list_state is None:
+                # Nothing new listed, mods that failed to download are still retried.
+                if hasattr(current_app, "mods_entries"):
+                    await start_mod_jobs(
+                        current_app.mods_entries,
+                        current_app.mods_searches,
+                        current_app.mods_file_ids,
+                        rebuilt=False,
+                    )
                 print(
-                    "Mods list loaded from redis in",
+                    "Mods list unchanged, checked in",
                     round(time.time() - start, 2),
                     "seconds",
                 )
-        else:
-            async with ClientSession() as session:
-                response = await session.get(
-                    f"https://trovesaurus.com/mods/api/hot?token={os.getenv('TROVESAURUS_TOKEN')}"
+                await asyncio.sleep(300)
+                return
+            hot_state = hot_state or fetch_state["hot"]
+            list_state = list_state or fetch_state["list"]
+            hot_data = {}
+            for mod in hot_state["data"]:
+                mod_id = int(mod["modid"])
+                if mod_id not in hot_data:
+                    hot_data[mod_id] = 0
+                hot_data[mod_id] += 1
+            # Only mods whose raw JSON changed since the last rebuild are validated again.
+            previous_mods = getattr(current_app, "mods_parsed", {})
+            parsed_mods = {}
+            cache = ModCache()
+            mod_files = await asyncio.to_thread(mod_store.hashes)
+            file_ids = {}
+            mod_searches = []
+            mod_entries = []
+            for i, mod in enumerate(list_state["data"], 1):
+                previous = previous_mods.get(mod["id"])
+                if previous is not None and previous[0] == mod:
+                    ts_mod = previous[1]
+                else:
+                    ts_mod = TrovesaurusMod(**mod)
+                parsed_mods[mod["id"]] = (mod, ts_mod)
+                last_update = ts_mod.date
+                for d in ts_mod.files:
+                    if d.date > last_update:
+                        last_update = d.date
+                mod_searches.append(
+                    SearchMod(
+                        id=ts_mod.id,
+                        name=ts_mod.name.lower(),
+                        authors=[author.Username.lower() for author in ts_mod.authors],
+                        type=ts_mod.type,
+                        sub_type=ts_mod.sub_type,
+                        likes=ts_mod.likes,
+                        views=ts_mod.views,
+                        downloads=ts_mod.downloads,
+                        last_update=last_update,
+                        hot=hot_data.get(ts_mod.id, 0),
+                    )
                 )
-                hot_raw_data = await response.json()
-                hot_data = {}
-                for mod in hot_raw_data:
-                    mod_id = int(mod["modid"])
-                    if mod_id not in hot_data:
-                        hot_data[mod_id] = 0
-                    hot_data[mod_id] += 1
-            async with ClientSession() as session:
-                async with session.get(
-                    f"https://trovesaurus.com/mods/api/list?token={os.getenv('TROVESAURUS_TOKEN')}"
-                ) as response:
-                    data = await response.json()
-                    cache = ModCache()
-                    mod_directory = Path("mods")
-                    mod_files = [
-                        file.stem for file in mod_directory.iterdir() if file.is_file()
-                    ]
-                    mod_searches = []
-                    mod_entries = []
-                    for i, mod in enumerate(data, 1):
-                        ts_mod = TrovesaurusMod(**mod)
-                        last_update = ts_mod.date
-                        for d in ts_mod.files:
-                            if d.date > last_update:
-                                last_update = d.date
-                        mod_searches.append(
-                            SearchMod(
-                                id=ts_mod.id,
-                                name=ts_mod.name.lower(),
-                                authors=[
-                                    author.Username.lower() for author in ts_mod.authors
-                                ],
-                                type=ts_mod.type,
-                                sub_type=ts_mod.sub_type,
-                                likes=ts_mod.likes,
-                                views=ts_mod.views,
-                                downloads=ts_mod.downloads,
-                                last_update=last_update,
-                                hot=hot_data.get(ts_mod.id, 0),
-                            )
+                cache[mod["id"]] = ts_mod
+                for file in cache[mod["id"]].files:
+                    if not file.hash:
+                        l("Mod List").error(f"Trovesaurus file {file.id} has no hash")
+                        continue
+                    # Crit can't fucking read
+                    if file.format.lower() in ["zip", "tmod"]:
+                        mod_entry = ModEntry(
+                            hash=file.hash,
+                            name=ts_mod.name,
+                            format=file.format,
+                            description=ts_mod.description,
+                            authors=ts_mod.authors,
                         )
-                        cache[mod["id"]] = ts_mod
-                        for file in cache[mod["id"]].files:
-                            if not file.hash:
-                                l("Mod List").error(
-                                    f"Trovesaurus file {file.id} has no hash"
-                                )
-                                continue
-                            # Crit can't fucking read
-                            if file.format.lower() in ["zip", "tmod"]:
-                                mod_entries.append(
-                                    ModEntry(
-                                        hash=file.hash,
-                                        name=ts_mod.name,
-                                        format=file.format,
-                                        description=ts_mod.description,
-                                        authors=ts_mod.authors,
-                                    )
-                                )
-                                path = Path(f"mods/{file.hash}.{file.format}")
-                                if file.hash not in mod_files:
-                                    req = f"https://trovesaurus.com/client/downloadfile.php?fileid={file.id}&no_track"
-                                    async with session.get(req) as file_response:
-                                        file_data = await file_response.read()
-                                        if md5(file_data).hexdigest() == file.hash:
-                                            path.write_bytes(file_data)
-                                            print("Downloaded", ts_mod.name)
-                                        else:
-                                            continue
-                                            l("Mod List").error(
-                                                f"Mod payload doesn't match hash: {file.hash}"
-                                            )
-                    cache.process_hashes()
-                    current_app.mods_list = cache
-                    await current_app.redis.set_object("mods_cache", cache)
-                    await current_app.redis.set_value(
-                        "mods_cache_updated", datetime.now(UTC).timestamp()
-                    )
-                    asyncio.create_task(
-                        offload_database_saves(mod_entries, mod_searches)
-                    )
-                    print(
-                        "Mods list updated in", round(time.time() - start, 2), "seconds"
-                    )
-                    await asyncio.sleep(1800)
+                        mod_entries.append(mod_entry)
+                        file_ids.setdefault(file.hash, file.id)
+            cache.set_hot(hot_data)
+            cache.process_hashes()
+            cache.build_orderings()
+            await asyncio.to_thread(
+                cache.build_path_index, mod_store.get_paths, mod_files
+            )
+            async with catalog_lock:
+                await publish_mods_catalog(
+                    cache, getattr(current_app, "mods_list", None)
+                )
+                current_app.mods_list = cache
+            # Only remembered once the catalog is live, a failed rebuild is retried.
+            current_app.mods_parsed = parsed_mods
+            current_app.mods_fetch_state = {"hot": hot_state, "list": list_state}
+            current_app.mods_entries = mod_entries
+            current_app.mods_searches = mod_searches
+            current_app.mods_file_ids = file_ids
+            await start_mod_jobs(mod_entries, mod_searches, file_ids)
+            print("Mods list updated in", round(time.time() - start, 2), "seconds")
+            await asyncio.sleep(300)
     except Exception as e:
         print(traceback.format_exc())
 
 
-async def offload_database_saves(mod_entries, search_mods):
-    for mod in mod_entries:
-        await ModEntry.find_one(ModEntry.hash == mod.hash).update(
-            {"$set": mod.model_dump(by_alias=True, exclude=["id"])}, upsert=True
+@tasks.loop(seconds=5)
+async def build_requested_previews():
+    try:
+        pubsub = await current_app.redis.subscribe("mod_previews")
+        try:
+            async for hash, format in current_app.redis.listen(pubsub):
+                preview_pipeline.queue(
+                    await asyncio.to_thread(preview_pipeline.missing, [(hash, format)])
+                )
+        finally:
+            await pubsub.aclose()
+    except Exception:
+        print(traceback.format_exc())
+
+
+async def fetch_if_changed(
+    session: ClientSession, url: str, state: Optional[dict]
+) -> Optional[dict]:
+    """Fetches url unless it's unchanged since state, returns the new state with its data.
+
+    Uses the ETag and Last-Modified validators when the server sends them and
+    falls back to comparing a hash of the body when it doesn't."""
+    state = state or {}
+    headers = {}
+    if state.get("etag"):
+        headers["If-None-Match"] = state["etag"]
+    if state.get("last_modified"):
+        headers["If-Modified-Since"] = state["last_modified"]
+    async with session.get(url, headers=headers) as response:
+        if response.status == 304:
+            return None
+        response.raise_for_status()
+        body = await response.read()
+        digest = md5(body).hexdigest()
+        if digest == state.get("digest"):
+            return None
+        return {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "digest": digest,
+            "data": loads(body),
+        }
+
+
+async def download_mod(file_id: int, mod_entry: ModEntry) -> Optional[bool]:
+    try:
+        path = await mod_downloader.submit(file_id, mod_entry.hash)
+    except (ClientError, asyncio.TimeoutError, OSError, ValueError) as e:
+        l("Mod List").error(f"Failed to download {mod_entry.hash}: {e}")
+        return None
+    print("Downloaded", mod_entry.name)
+    try:
+        return await ingest_mod(mod_entry, path)
+    finally:
+        mod_downloader.discard(mod_entry.hash)
+
+
+async def start_mod_jobs(mod_entries, mod_searches, file_ids, rebuilt: bool = True):
+    """Fills entries from stored verifications and starts jobs for the missing mods.
+
+    Mods not in the store are downloaded and stored ones without a result are
+    verified, the database is saved once they finish. Without a rebuilt list
+    nothing is saved unless a job had to be started again."""
+    quarantined = await asyncio.to_thread(mod_store.quarantined)
+    mod_files = await asyncio.to_thread(mod_store.hashes)
+    verifications = await asyncio.to_thread(mod_store.get_verifications, mod_files)
+    mod_entries = [entry for entry in mod_entries if entry.hash not in quarantined]
+    jobs = {}
+    downloads = set()
+    started = False
+    for mod_entry in mod_entries:
+        hash = mod_entry.hash
+        if hash in verifications:
+            mod_entry.set_verification(verifications[hash])
+        elif hash in jobs:
+            continue
+        elif hash in pending_mods:
+            jobs[hash] = pending_mods[hash]
+        elif hash in mod_files:
+            jobs[hash] = submit_mod(mod_entry)
+            started = True
+        else:
+            jobs[hash] = submit_mod(mod_entry, file_ids[hash])
+            downloads.add(hash)
+            started = True
+    # Jobs still in flight are saved by the batch that started them.
+    if not rebuilt and not started:
+        return
+    current_app.mods_generation = getattr(current_app, "mods_generation", 0) + 1
+    asyncio.create_task(
+        finish_mod_downloads(
+            jobs, downloads, mod_entries, mod_searches, current_app.mods_generation
+        )
+    )
+
+
+def submit_mod(mod_entry: ModEntry, file_id: Optional[int] = None) -> asyncio.Future:
+    """Downloads and ingests a mod, or verifies a stored one, once per hash."""
+    future = pending_mods.get(mod_entry.hash)
+    if future is None:
+        future = asyncio.ensure_future(process_mod(mod_entry, file_id))
+        future.add_done_callback(lambda _: pending_mods.pop(mod_entry.hash, None))
+        pending_mods[mod_entry.hash] = future
+    return future
+
+
+async def process_mod(mod_entry: ModEntry, file_id: Optional[int]) -> Optional[bool]:
+    try:
+        if file_id is None:
+            return await verify_stored_mod(mod_entry)
+        return await download_mod(file_id, mod_entry)
+    except (OSError, ValueError) as e:
+        l("Mod List").error(f"Failed to ingest {mod_entry.hash}: {e}")
+        return None
+
+
+async def finish_mod_downloads(jobs, downloads, mod_entries, mod_searches, generation):
+    """Waits for the mods being ingested or verified once the catalog is already live.
+
+    Jobs are shared with other refreshes, a mod in flight is only awaited again."""
+    try:
+        results = dict(zip(jobs.keys(), await asyncio.gather(*jobs.values())))
+        downloaded = {hash for hash in downloads if results[hash]}
+        removed = {hash for hash, valid in results.items() if valid is False}
+        mod_entries = [
+            entry for entry in mod_entries if results.get(entry.hash) is not False
+        ]
+        # Only one entry per hash went through ingest, the others share its result.
+        verifications = await asyncio.to_thread(
+            mod_store.get_verifications, {entry.hash for entry in mod_entries}
+        )
+        for entry in mod_entries:
+            if entry.hash in verifications:
+                entry.set_verification(verifications[entry.hash])
+        preview_pipeline.queue(
+            await asyncio.to_thread(
+                preview_pipeline.missing,
+                [(entry.hash, entry.format.lower()) for entry in mod_entries],
+            )
+        )
+        if downloaded or removed:
+            asyncio.create_task(
+                asyncio.to_thread(
+                    mod_store.build_deltas,
+                    [
+                        (old.hash, new.hash)
+                        for ts_mod in current_app.mods_list
+                        for old, new in ts_mod.update_pairs
+                        if new.hash in downloaded
+                    ],
+                )
+            )
+            while True:
+                cache = current_app.mods_list
+                version = cache.version
+                await asyncio.to_thread(
+                    cache.build_path_index,
+                    mod_store.get_paths,
+                    await asyncio.to_thread(mod_store.hashes),
+                )
+                async with catalog_lock:
+                    # Retried on the newer catalog if a refresh swapped it in meanwhile.
+                    if current_app.mods_list is cache and cache.version == version:
+                        await publish_mods_catalog(cache, cache, files_changed=True)
+                        break
+        await offload_database_saves(mod_entries, mod_searches, generation)
+    except Exception:
+        print(traceback.format_exc())
+
+
+async def publish_mods_catalog(
+    cache: ModCache, previous: Optional[ModCache], files_changed: bool = False
+):
+    """Stores the catalog and the changes since the previous one, then wakes followers."""
+    redis = current_app.redis
+    changes = cache.diff(previous) if previous is not None else None
+    cache.version = await redis.incr("mods_catalog_version")
+    if changes is not None:
+        changes["version"] = cache.version
+        changes["files_changed"] |= files_changed
+    await redis.set_object("mods_cache", cache)
+    await redis.set_object(f"mods_catalog_changes_{cache.version}", changes)
+    await redis.expire(f"mods_catalog_changes_{cache.version}", 86400)
+    await redis.publish("mods_catalog", cache.version)
+
+
+async def sync_mods_catalog(version: int):
+    """Brings this worker's catalog up to version, loading a snapshot if changes are missing."""
+    start = time.time()
+    cache = getattr(current_app, "mods_list", None)
+    current = getattr(cache, "version", 0)
+    if cache is not None and current >= version:
+        return
+    changes = []
+    if cache is not None:
+        for next_version in range(current + 1, version + 1):
+            change = await current_app.redis.get_object(
+                f"mods_catalog_changes_{next_version}"
+            )
+            if change is None:
+                break
+            changes.append(change)
+    if cache is not None and len(changes) == version - current:
+        for change in changes:
+            cache.apply_changes(change)
+        if any(change["files_changed"] for change in changes):
+            await asyncio.to_thread(cache.build_path_index, mod_store.get_paths)
+        print(
+            f"Mods list synced {len(changes)} versions in",
+            round(time.time() - start, 2),
+            "seconds",
         )
-    for mod in search_mods:
-        await SearchMod.find_one(SearchMod.id == mod.id).update(
-            {"$set": mod.model_dump(by_alias=True, exclude=["id"])}, upsert=True
+        return
+    cache = await current_app.redis.get_object("mods_cache")
+    if cache is None:
+        return
+    current_app.mods_list = cache
+    print("Mods list loaded from redis in", round(time.time() - start, 2), "seconds")
+
+
+async def offload_database_saves(mod_entries, search_mods, generation: int):
+    """Writes the entries that changed since the last sync and deletes vanished ones.
+
+    Saves run one at a time and a batch older than the last saved one is dropped."""
+    async with database_lock:
+        if generation < getattr(current_app, "mods_saved_generation", 0):
+            print("Skipped saving an outdated mod list")
+            return
+        # In memory only, a restarted main worker wipes ModEntry before its first sync.
+        snapshot = getattr(current_app, "mods_database_snapshot", {})
+        entries, entries_changed, entries_removed = await sync_documents(
+            ModEntry,
+            "hash",
+            {
+                mod.hash: mod.model_dump(by_alias=True, exclude=["id"])
+                for mod in mod_entries
+            },
+            snapshot.get("entries"),
         )
-    print("Mod list update task complete.")
+        searches, searches_changed, searches_removed = await sync_documents(
+            SearchMod,
+            "_id",
+            {
+                mod.id: mod.model_dump(by_alias=True, exclude=["id"])
+                for mod in search_mods
+            },
+            snapshot.get("searches"),
+        )
+        current_app.mods_database_snapshot = {"entries": entries, "searches": searches}
+        print(
+            "Mod list update task complete.",
+            f"Entries: {entries_changed} written, {entries_removed} removed.",
+            f"Searches: {searches_changed} written, {searches_removed} removed.",
+        )
+        current_app.mods_saved_generation = generation
+
+
+async def sync_documents(model, field: str, documents: dict, previous: Optional[dict]):
+    digests = {
+        key: md5(dumps(document, sort_keys=True, default=str).encode()).hexdigest()
+        for key, document in documents.items()
+    }
+    changed = [
+        key
+        for key, digest in digests.items()
+        if previous is None or previous.get(key) != digest
+    ]
+    if previous is None:
+        # No snapshot to compare with, clear out everything the list doesn't have.
+        removed = None
+        removed_query = {field: {"$nin": list(documents)}}
+    else:
+        removed = [key for key in previous if key not in documents]
+        removed_query = {field: {"$in": removed}}
+    async with BulkWriter(ordered=False, object_class=model) as bulk_writer:
+        for key in changed:
+            await model.find_one({field: key}).update(
+                {"$set": documents[key]}, upsert=True, bulk_writer=bulk_writer
+            )
+        if removed is None or removed:
+            await model.find(removed_query).delete(bulk_writer=bulk_writer)
+    return digests, len(changed), len(removed or ())
 
 
 @update_mods_list.before_loop
@@ -147,9 +506,11 @@ async def before_update_mods_list():
     l("Mod List").info("Mod list update task starting.")
     if current_app.main_worker:
         try:
+            migrated = await asyncio.to_thread(mod_store.migrate)
+            if migrated:
+                print(f"Moved {migrated} mods into the mod store")
             async for mod_entry in ModEntry.find_many({}):
-                path = Path(f"mods/{mod_entry.hash}.{mod_entry.format}")
-                if not path.exists():
+                if mod_entry.hash not in mod_store:
                     print(f"Mod {mod_entry.hash} not found in mods directory")
                 await mod_entry.delete()
             print("Mod list check complete")
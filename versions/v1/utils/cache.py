@@ -1,5 +1,9 @@
+import bisect
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
+from .functions import TroveHash, deflate_raw
 from .trovesaurus import TrovesaurusMod
 
 
@@ -11,10 +15,18 @@ class SortOrder(Enum):
 class ModCache:
     """This class is used to cache data in memory."""
 
-    def __init__(self):
+    sortable_fields = ("views", "downloads", "likes", "date", "hot")
+
+    def __init__(self, query_cache_size: int = 256):
         self._data = {}
-        self._cached_queries = {}
+        self._cached_queries = OrderedDict()
         self._processed_hashes = {}
+        self._hot = {}
+        self._orderings = None
+        self._dumps = {}
+        self.query_cache_size = query_cache_size
+        self.version = 0
+        self.path_index = ModPathIndex()
 
     def __str__(self):
         return f"<ModCache mods={len(self)}>"
@@ -43,6 +55,7 @@ class ModCache:
     def _add_item(self, key, value: TrovesaurusMod):
         """Add an item to the cache."""
         self._data[key] = value
+        self._invalidate()
 
     def _get_item(self, key):
         """Get an item from the cache."""
@@ -51,6 +64,7 @@ class ModCache:
     def _remove_item(self, key):
         """Remove an item from the cache."""
         del self._data[key]
+        self._invalidate()
 
     def is_populated(self):
         return bool(self._data)
@@ -58,8 +72,57 @@ class ModCache:
     def clear(self):
         """Clear the cache."""
         self._data = {}
+        self._invalidate()
+
+    def _invalidate(self):
+        self._orderings = None
+        self._dumps = {}
+        self._cached_queries.clear()
+
+    def set_hot(self, hot: dict[int, int]):
+        self._hot = hot
+        self._invalidate()
+
+    def _sort_value(self, mod: TrovesaurusMod, field: str):
+        if field == "hot":
+            return self._hot.get(mod.id, 0)
+        return getattr(mod, field)
+
+    def build_orderings(self):
+        """Presort the mods by every sortable field, pages are then slices."""
+        orderings = {}
+        for field in self.sortable_fields:
+            ordering = sorted(self, key=lambda m: self._sort_value(m, field))
+            orderings[(field, SortOrder.asc)] = ordering
+            orderings[(field, SortOrder.desc)] = ordering[::-1]
+        self._orderings = orderings
+        return orderings
+
+    def _dump(self, mod: TrovesaurusMod) -> dict:
+        dump = self._dumps.get(mod.id)
+        if dump is None:
+            dump = self._dumps[mod.id] = mod.model_dump(by_alias=True)
+        return dump
+
+    def _sort(self, fields: tuple[tuple[str, SortOrder], ...]) -> list:
+        if self._orderings is None:
+            self.build_orderings()
+        if not fields:
+            return list(self)
+        ordering = self._orderings.get(fields[0])
+        if len(fields) == 1 and ordering is not None:
+            return ordering
+        # Stable sorts from the least significant field keep the earlier ones in charge.
+        mods = list(self)
+        for field, order in reversed(fields):
+            mods.sort(
+                key=lambda m: self._sort_value(m, field),
+                reverse=order == SortOrder.desc,
+            )
+        return mods
 
     def process_hashes(self):
+        self._processed_hashes = {}
         for mod in self:
             for file in mod.files:
                 if file.hash:
@@ -72,23 +135,42 @@ class ModCache:
         url_query += "#".join(f"{field[0]}${field[1].value}" for field in fields)
         url_query += f"&limit={limit}" if limit else ""
         url_query += f"&offset={offset}" if offset else ""
-        if url_query not in self._cached_queries:
-            print("Not cached")
-            self._cached_queries[url_query] = [
-                mod.model_dump(by_alias=True)
-                for mod in sorted(
-                    self,
-                    key=lambda m: tuple(
-                        (
-                            getattr(m, field[0])
-                            if field[1] == SortOrder.ASCENDING
-                            else -getattr(m, field[0])
-                        )
-                        for field in fields
-                    ),
-                )[offset:][:limit]
-            ]
-        return self._cached_queries[url_query]
+        if url_query in self._cached_queries:
+            self._cached_queries.move_to_end(url_query)
+            return self._cached_queries[url_query]
+        start = offset or 0
+        end = start + limit if limit else None
+        result = [self._dump(mod) for mod in self._sort(fields)[start:end]]
+        self._cached_queries[url_query] = result
+        while len(self._cached_queries) > self.query_cache_size:
+            self._cached_queries.popitem(last=False)
+        return result
+
+    def diff(self, previous: "ModCache") -> dict:
+        """Changes that turn the previous catalog into this one."""
+        changed = {key: mod for key, mod in self._data.items() if previous[key] != mod}
+        removed = [key for key in previous._data if key not in self._data]
+        files_changed = any(
+            previous[key] is None or previous[key].files != mod.files
+            for key, mod in changed.items()
+        ) or any(previous[key].files for key in removed)
+        return {
+            "version": self.version,
+            "changed": changed,
+            "removed": removed,
+            "hot": self._hot,
+            "files_changed": files_changed,
+        }
+
+    def apply_changes(self, changes: dict):
+        for key, mod in changes["changed"].items():
+            self._data[key] = mod
+        for key in changes["removed"]:
+            self._data.pop(key, None)
+        self.set_hot(changes["hot"])
+        self.process_hashes()
+        self.build_orderings()
+        self.version = changes["version"]
 
     def get_mod_tags(self) -> list[str]:
         tags = set()
@@ -104,6 +186,41 @@ class ModCache:
                 tags.add(mod.sub_type)
         return sorted(list(tags))
 
+    def build_path_index(self, get_paths, hashes=None):
+        """Index the game paths of every mod file, get_paths returns the paths of a hash."""
+        index = ModPathIndex()
+        for mod in self:
+            for file in mod.files:
+                if not file.hash or (hashes is not None and file.hash not in hashes):
+                    continue
+                try:
+                    paths = get_paths(file.hash)
+                except (OSError, ValueError):
+                    continue
+                index.add(mod.id, file.hash, paths)
+        index.sort()
+        self.path_index = index
+        return index
+
+    def get_conflicts(self, hashes) -> dict:
+        names = {}
+        for hash in dict.fromkeys(hashes):
+            mod = self.get_trovesaurus_mod(hash)
+            if mod is not None:
+                names.setdefault(mod.name, []).append(hash)
+        return {
+            "names": {name: found for name, found in names.items() if len(found) > 1},
+            "files": self.path_index.get_overlaps(hashes),
+            "unknown": [
+                hash
+                for hash in dict.fromkeys(hashes)
+                if not self.path_index.has_hash(hash)
+            ],
+        }
+
+    def get_trovesaurus_mod(self, hash) -> TrovesaurusMod:
+        return self._processed_hashes.get(hash)
+
     def get_mod_by_hash(self, hash):
         mod = self._processed_hashes.get(hash)
         if mod:
@@ -114,3 +231,167 @@ class ModCache:
         for hash in list(set(hashes)):
             mods[hash] = self.get_mod_by_hash(hash)
         return mods
+
+
+class ModPathIndex:
+    """This class maps game paths to the mods and files that replace them."""
+
+    def __init__(self):
+        self._entries = {}
+        self._paths = []
+        self._path_ids = {}
+        self._path_names = []
+        self._hash_paths = {}
+
+    def __str__(self):
+        return f"<ModPathIndex paths={len(self)}>"
+
+    def __repr__(self):
+        return str(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, path):
+        return self.normalize(path) in self._entries
+
+    @staticmethod
+    def normalize(path: str) -> str:
+        path = path.strip().replace("\\", "/").lower()
+        while path.startswith(("./", "/")):
+            path = path[2:] if path.startswith("./") else path[1:]
+        return path
+
+    def add(self, mod_id: int, hash: str, paths: list[str]):
+        entry = {"mod_id": mod_id, "hash": hash}
+        path_ids = set()
+        for path in paths:
+            path = self.normalize(path)
+            self._entries.setdefault(path, []).append(entry)
+            path_id = self._path_ids.get(path)
+            if path_id is None:
+                path_id = self._path_ids[path] = len(self._path_names)
+                self._path_names.append(path)
+            path_ids.add(path_id)
+        self._hash_paths[hash] = frozenset(path_ids)
+
+    def has_hash(self, hash: str) -> bool:
+        return hash in self._hash_paths
+
+    def get_overlaps(self, hashes: list[str]) -> dict[str, list[str]]:
+        hashes = [hash for hash in dict.fromkeys(hashes) if hash in self._hash_paths]
+        seen = set()
+        shared = set()
+        for hash in hashes:
+            paths = self._hash_paths[hash]
+            shared |= paths & seen
+            seen |= paths
+        overlaps = {}
+        for hash in hashes:
+            for path_id in self._hash_paths[hash] & shared:
+                overlaps.setdefault(self._path_names[path_id], []).append(hash)
+        return overlaps
+
+    def sort(self):
+        self._paths = sorted(self._entries)
+
+    def get(self, path: str) -> list[dict]:
+        return self._entries.get(self.normalize(path), [])
+
+    def get_prefix(self, prefix: str, limit: int = None) -> dict[str, list[dict]]:
+        prefix = self.normalize(prefix)
+        results = {}
+        for i in range(bisect.bisect_left(self._paths, prefix), len(self._paths)):
+            path = self._paths[i]
+            if not path.startswith(prefix) or (limit and len(results) >= limit):
+                break
+            results[path] = self._entries[path]
+        return results
+
+
+class FileBlockCache:
+    """This class caches per-file checksums and compressed data by content hash.
+
+    Files with the same content share one entry, so recompiling a mod only has
+    to encode the files that changed since the last compile."""
+
+    # Rough size of a block without compressed data, so checksum-only blocks age out too.
+    block_overhead = 128
+
+    def __init__(self, max_size: int = 128 * 1024 * 1024, workers: int = None):
+        self.max_size = max_size
+        self.workers = workers
+        self._blocks = OrderedDict()
+        self._size = 0
+        self._executor = None
+
+    def __str__(self):
+        return f"<FileBlockCache blocks={len(self)} size={self._size}>"
+
+    def __repr__(self):
+        return str(self)
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def __contains__(self, key):
+        return key in self._blocks
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers)
+        return self._executor
+
+    def _get_block(self, key: bytes) -> dict:
+        block = self._blocks.get(key)
+        if block is None:
+            block = self._blocks[key] = {"size": 0}
+            self._add_size(block, self.block_overhead)
+        else:
+            self._blocks.move_to_end(key)
+        return block
+
+    def _add_size(self, block: dict, size: int):
+        block["size"] += size
+        self._size += size
+        while self._size > self.max_size and len(self._blocks) > 1:
+            _, evicted = self._blocks.popitem(last=False)
+            self._size -= evicted["size"]
+
+    def checksum(self, key: bytes, data) -> int:
+        block = self._get_block(key)
+        if "checksum" not in block:
+            checksum = TroveHash(data)
+            if len(data) % 4 != 0:
+                checksum.update(b"\x00" * (4 - (len(data) % 4)))
+            block["checksum"] = checksum.digest()
+        return block["checksum"]
+
+    def deflate(self, key: bytes, data) -> tuple[int, bytes]:
+        block = self._get_block(key)
+        if "deflated" not in block:
+            block["deflated"] = deflate_raw(data)
+            self._add_size(block, len(block["deflated"][1]))
+        return block["deflated"]
+
+    def deflate_many(self, items: list[tuple[bytes, bytes]]) -> list[tuple[int, bytes]]:
+        """Deflates (key, data) pairs in order, compressing uncached ones concurrently.
+
+        zlib releases the GIL, so the worker threads use every core. Only the
+        compression runs in the pool, the cache itself is updated here."""
+        missing = {}
+        for key, data in items:
+            if "deflated" not in self._blocks.get(key, ()):
+                missing.setdefault(key, data)
+        if len(missing) > 1:
+            results = self.executor.map(deflate_raw, missing.values())
+            for key, deflated in zip(missing.keys(), results):
+                block = self._get_block(key)
+                block["deflated"] = deflated
+                self._add_size(block, len(deflated[1]))
+        return [self.deflate(key, data) for key, data in items]
+
+    def clear(self):
+        self._blocks.clear()
+        self._size = 0
@@ -1,13 +1,22 @@
 from __future__ import annotations
 
+import asyncio
+import bisect
 import datetime
+import hashlib
 import random
+import struct
+import sys
 import time
+import zipfile
+import zlib
+from array import array
 from random import sample
 from string import ascii_letters, digits
-from typing import Callable, Generic, Literal, TypeVar, Union, overload
+from typing import Callable, Generic, Literal, Optional, TypeVar, Union, overload
 from binary_reader import BinaryReader
 import humanize
+import toml
 
 
 def random_id(k=8):
@@ -103,6 +112,262 @@ def chunks(lst, n):
     return result
 
 
+def iter_blocks(parts, size):
+    buffer = bytearray()
+    for part in parts:
+        part = memoryview(part).cast("B")
+        if buffer:
+            missing = size - len(buffer)
+            buffer += part[:missing]
+            part = part[missing:]
+            if len(buffer) < size:
+                continue
+            yield bytes(buffer)
+            buffer.clear()
+        whole = len(part) - len(part) % size
+        for start in range(0, whole, size):
+            yield part[start : start + size]
+        buffer += part[whole:]
+    if buffer:
+        yield bytes(buffer)
+
+
+def file_md5(path):
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "md5").hexdigest()
+
+
+def iter_file(path, chunk_size=32768):
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+def compress_stream(parts, block_size=32768):
+    """Frames data as stored deflate blocks, the same bytes zlib writes at level 0
+    followed by a sync flush."""
+    yield b"\x78\x01"
+    for block in iter_blocks(parts, block_size):
+        size = len(block)
+        yield b"".join(
+            [b"\x00", size.to_bytes(2, "little"), (size ^ 0xFFFF).to_bytes(2, "little")]
+        )
+        yield block
+    yield b"\x00\x00\x00\xFF\xFF"
+
+
+def _check_zlib_header(header):
+    if (
+        len(header) < 2
+        or header[0] & 0x0F != 8
+        or header[1] & 0x20
+        or (header[0] << 8 | header[1]) % 31
+    ):
+        raise ValueError("Not a zlib stream")
+
+
+def _read_stored_header(block, strict=True):
+    if len(block) < 5:
+        raise ValueError("Truncated stored block header")
+    if block[0] & 0x06:
+        raise ValueError("Stream contains compressed deflate blocks")
+    size = block[1] | block[2] << 8
+    if strict and size ^ (block[3] | block[4] << 8) != 0xFFFF:
+        raise ValueError("Stored block length check failed")
+    return block[0] & 0x01, size
+
+
+def DecodeStoredDeflate(data, strict=True):
+    """Joins the blocks of a zlib stream made only of stored deflate blocks.
+
+    Raises ValueError when the stream has compressed blocks or broken framing,
+    with strict=False the zlib header and block length checks are skipped."""
+    data = memoryview(data).cast("B")
+    if strict:
+        _check_zlib_header(data[:2])
+    blocks = []
+    pos = 2
+    end = len(data)
+    while pos < end:
+        final, size = _read_stored_header(data[pos : pos + 5], strict)
+        pos += 5
+        if pos + size > end:
+            raise ValueError("Truncated stored block")
+        blocks.append(data[pos : pos + size])
+        pos += size
+        if final:
+            break
+    return b"".join(blocks)
+
+
+def deflate_raw(data):
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return zlib.crc32(data), compressor.compress(data) + compressor.flush()
+
+
+_ZIP_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+_ZIP_CENTRAL_HEADER = struct.Struct("<4s4B4HL2L5H2L")
+_ZIP_END_RECORD = struct.Struct("<4s4H2LH")
+_ZIP_DATE = (0 << 9) | (1 << 5) | 1  # 1980-01-01, keeps the output reproducible
+
+
+def zip_preview_path(metadata) -> Optional[str]:
+    """The lowercased previewPath from a zip mod's metadata.toml, if it has one."""
+    try:
+        properties = toml.loads(bytes(metadata).decode("utf-8")).get("properties", {})
+    except (UnicodeDecodeError, toml.TomlDecodeError):
+        return None
+    value = properties.get("previewPath") if isinstance(properties, dict) else None
+    if isinstance(value, str) and value:
+        return value.replace("\\", "/").lower()
+    return None
+
+
+def write_zip(fp, entries):
+    """Writes a deflated zip from (name, crc32, size, deflated data) entries.
+
+    The data is written as given, so callers can reuse compressed members
+    between archives. Zip64 archives are not supported."""
+    offset = 0
+    directory = []
+    for name, crc, size, data in entries:
+        name = name.encode("utf-8")
+        flags = 0 if name.isascii() else 0x800
+        if max(offset, size, len(data)) > 0xFFFFFFFF or len(directory) >= 0xFFFF:
+            raise ValueError("Archive is too large for a zip without Zip64")
+        fp.write(
+            _ZIP_LOCAL_HEADER.pack(
+                b"PK\x03\x04",
+                20,
+                0,
+                flags,
+                zipfile.ZIP_DEFLATED,
+                0,
+                _ZIP_DATE,
+                crc,
+                len(data),
+                size,
+                len(name),
+                0,
+            )
+        )
+        fp.write(name)
+        fp.write(data)
+        directory.append(
+            _ZIP_CENTRAL_HEADER.pack(
+                b"PK\x01\x02",
+                20,
+                3,
+                20,
+                0,
+                flags,
+                zipfile.ZIP_DEFLATED,
+                0,
+                _ZIP_DATE,
+                crc,
+                len(data),
+                size,
+                len(name),
+                0,
+                0,
+                0,
+                0,
+                0o600 << 16,
+                offset,
+            )
+            + name
+        )
+        offset += _ZIP_LOCAL_HEADER.size + len(name) + len(data)
+    if offset > 0xFFFFFFFF:
+        raise ValueError("Archive is too large for a zip without Zip64")
+    directory_data = b"".join(directory)
+    fp.write(directory_data)
+    fp.write(
+        _ZIP_END_RECORD.pack(
+            b"PK\x05\x06",
+            0,
+            0,
+            len(directory),
+            len(directory),
+            len(directory_data),
+            offset,
+            0,
+        )
+    )
+
+
+class StoredBlockIndex:
+    """Position of every stored deflate block in a zlib stream.
+
+    Streams written with compression level 0 are a sequence of stored blocks,
+    so any uncompressed range can be read by seeking to the blocks it spans
+    instead of inflating everything before it."""
+
+    __slots__ = ("starts", "positions", "sizes", "size")
+
+    def __init__(self, starts, positions, sizes):
+        self.starts = starts
+        self.positions = positions
+        self.sizes = sizes
+        self.size = starts[-1] + sizes[-1] if starts else 0
+
+    def __repr__(self):
+        return f"<StoredBlockIndex blocks={len(self.starts)} size={self.size}>"
+
+    @classmethod
+    def from_file(cls, fp, offset=None):
+        if offset is not None:
+            fp.seek(offset)
+        _check_zlib_header(fp.read(2))
+        starts, positions, sizes = [], [], []
+        position = fp.tell()
+        total = 0
+        while block := fp.read(5):
+            final, size = _read_stored_header(block)
+            position += 5
+            if size:
+                starts.append(total)
+                positions.append(position)
+                sizes.append(size)
+            total += size
+            position += size
+            if final:
+                break
+            fp.seek(position)
+        if fp.seek(0, 2) < position:
+            raise ValueError("Truncated stored block")
+        return cls(starts, positions, sizes)
+
+    def iter_range(self, fp, offset, size, chunk_size=65536):
+        end = min(offset + size, self.size)
+        block = max(bisect.bisect_right(self.starts, offset) - 1, 0)
+        while offset < end:
+            start = offset - self.starts[block]
+            length = min(self.sizes[block] - start, end - offset)
+            fp.seek(self.positions[block] + start)
+            while length > 0:
+                chunk = fp.read(min(length, chunk_size))
+                if not chunk:
+                    raise ValueError("Truncated stored block")
+                length -= len(chunk)
+                offset += len(chunk)
+                yield chunk
+            block += 1
+
+    def read_range(self, fp, offset, size):
+        return b"".join(self.iter_range(fp, offset, size))
+
+
+async def iterate_in_thread(iterator):
+    iterator = iter(iterator)
+    missing = _MissingSentinel()
+    while True:
+        item = await asyncio.to_thread(next, iterator, missing)
+        if item is missing:
+            break
+        yield item
+
+
 def ReadLeb128(buffer: BinaryReader, pos):
     result = 0
     shift = 0
@@ -121,7 +386,62 @@ def ReadLeb128(buffer: BinaryReader, pos):
                 raise Exception("Too many bytes when decoding varint.")
 
 
+def DecodeLeb128(data, pos=0):
+    byte = data[pos]
+    pos += 1
+    if byte < 0x80:
+        return byte, pos
+    result = byte & 0x7F
+    shift = 7
+    while 1:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result & 0xFFFFFFFF, pos
+        shift += 7
+        if shift >= 64:
+            raise Exception("Too many bytes when decoding varint.")
+
+
+def DecodeString(data, pos, size):
+    end = pos + size
+    value = bytes(data[pos:end]).split(b"\x00", 1)[0].decode("utf-8")
+    return value, end
+
+
+def DecodeProperties(data, pos, count):
+    properties = []
+    for _ in range(count):
+        size, pos = DecodeLeb128(data, pos)
+        name, pos = DecodeString(data, pos, size)
+        size, pos = DecodeLeb128(data, pos)
+        value, pos = DecodeString(data, pos, size)
+        properties.append((name, value))
+    return properties, pos
+
+
+def DecodeFileTable(data, pos, end, fields=4):
+    entries = []
+    while pos < end:
+        name_size = data[pos]
+        name, pos = DecodeString(data, pos + 1, name_size)
+        entry = [name]
+        for _ in range(fields):
+            byte = data[pos]
+            pos += 1
+            if byte < 0x80:
+                entry.append(byte)
+            else:
+                value, pos = DecodeLeb128(data, pos - 1)
+                entry.append(value)
+        entries.append(tuple(entry))
+    return entries, pos
+
+
 def WriteLeb128(value):
+    if value < 0x80:
+        return bytes((value,))
     result = bytearray()
     while value >= 0x80:
         result.append((value & 0x7F) | 0x80)
@@ -131,26 +451,87 @@ def WriteLeb128(value):
     return bytes(result)
 
 
-def calculate_hash(data):
-    hash_value = 0x811C9DC5
+def EncodeProperties(properties):
+    return b"".join(
+        WriteLeb128(len(name))
+        + name.encode("utf-8")
+        + WriteLeb128(len(value))
+        + value.encode("utf-8")
+        for name, value in properties
+    )
+
+
+def EncodeFileTableEntry(name, *values):
+    return b"".join(
+        [bytes((len(name),)), name.encode("utf-8"), *map(WriteLeb128, values)]
+    )
+
+
+class TroveHash:
+    """Incremental version of the Trove checksum (FNV-1a over little endian words).
+
+    Data can be fed in any number of `update` calls, only the bytes that don't
+    complete a word are held back until more data or `digest` arrives."""
+
+    offset_basis = 0x811C9DC5
     prime = 0x1000193
-    length = len(data)
-    length_aligned = length & ~3
-
-    for i in range(0, length_aligned, 4):
-        chunk = data[i] | (data[i + 1] << 8) | (data[i + 2] << 16) | (data[i + 3] << 24)
-        hash_value ^= chunk
-        hash_value = (hash_value * prime) & 0xFFFFFFFF
-
-    if length - length_aligned > 0:
-        remainder = length - length_aligned
-        chunk = 0
-        for i in range(remainder):
-            chunk |= data[length_aligned + i] << (i * 8)
-        hash_value ^= chunk
-        hash_value = (hash_value * prime) & 0xFFFFFFFF
-
-    return hash_value
+    block_size = 1 << 20
+
+    __slots__ = ("_value", "_pending")
+
+    def __init__(self, data=None):
+        self._value = self.offset_basis
+        self._pending = b""
+        if data is not None:
+            self.update(data)
+
+    def update(self, data):
+        data = memoryview(data).cast("B")
+        if self._pending:
+            missing = 4 - len(self._pending)
+            self._pending += data[:missing].tobytes()
+            data = data[missing:]
+            if len(self._pending) < 4:
+                return self
+            self._value = _hash_words(self._value, self._pending)
+            self._pending = b""
+        aligned = len(data) & ~3
+        for start in range(0, aligned, self.block_size):
+            end = min(start + self.block_size, aligned)
+            self._value = _hash_words(self._value, data[start:end])
+        self._pending = data[aligned:].tobytes()
+        return self
+
+    def digest(self):
+        value = self._value
+        if self._pending:
+            value ^= int.from_bytes(self._pending, "little")
+            value = (value * self.prime) & 0xFFFFFFFF
+        return value
+
+    def copy(self):
+        other = TroveHash()
+        other._value = self._value
+        other._pending = self._pending
+        return other
+
+
+_WORD_TYPECODE = "I" if array("I").itemsize == 4 else "L"
+
+
+def _hash_words(value, data):
+    words = array(_WORD_TYPECODE)
+    words.frombytes(data)
+    if sys.byteorder == "big":
+        words.byteswap()
+    prime = TroveHash.prime
+    for word in words:
+        value = ((value ^ word) * prime) & 0xFFFFFFFF
+    return value
+
+
+def calculate_hash(data):
+    return TroveHash(data).digest()
 
 
 # def calculate_hash(data):
@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import asyncio
+from hashlib import md5
+from pathlib import Path
+
+from aiohttp import ClientError, ClientSession, ClientTimeout
+
+from .functions import ExponentialBackoff, random_id
+from .mod_store import mod_store
+
+
+class ModDownloader:
+    """Downloads mod files from Trovesaurus in the background.
+
+    Files are streamed to a temporary file while their md5 is computed and are
+    only renamed into place once it matches the expected hash. Failed downloads
+    are retried with exponential backoff."""
+
+    url = "https://trovesaurus.com/client/downloadfile.php?fileid={}&no_track"
+
+    def __init__(
+        self,
+        path: Path,
+        concurrency: int = 4,
+        attempts: int = 5,
+        chunk_size: int = 65536,
+    ):
+        self.path = path
+        self.concurrency = concurrency
+        self.attempts = attempts
+        self.chunk_size = chunk_size
+        self._semaphore = None
+        self._pending = {}
+
+    def __str__(self):
+        return f"<ModDownloader pending={len(self._pending)}>"
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    def get_path(self, hash: str) -> Path:
+        return self.path.joinpath(hash)
+
+    def submit(self, file_id: int, hash: str) -> asyncio.Future:
+        future = self._pending.get(hash)
+        if future is None:
+            future = asyncio.ensure_future(self.download(file_id, hash))
+            future.add_done_callback(lambda _: self._pending.pop(hash, None))
+            self._pending[hash] = future
+        return future
+
+    async def download(self, file_id: int, hash: str) -> Path:
+        path = self.get_path(hash)
+        if path.exists():
+            return path
+        backoff = ExponentialBackoff()
+        for attempt in range(1, self.attempts + 1):
+            try:
+                async with self.semaphore:
+                    return await self._fetch(file_id, hash, path)
+            except (ClientError, asyncio.TimeoutError, ValueError) as e:
+                if attempt == self.attempts:
+                    raise
+                delay = backoff.delay()
+                print(f"Download of {hash} failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def _fetch(self, file_id: int, hash: str, path: Path) -> Path:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f"{path.name}.{random_id()}.tmp")
+        checksum = md5()
+        timeout = ClientTimeout(total=None, sock_connect=30, sock_read=60)
+        try:
+            async with ClientSession(timeout=timeout) as session:
+                async with session.get(self.url.format(file_id)) as response:
+                    response.raise_for_status()
+                    with open(temp_path, "wb") as f:
+                        async for chunk in response.content.iter_chunked(
+                            self.chunk_size
+                        ):
+                            checksum.update(chunk)
+                            f.write(chunk)
+            if checksum.hexdigest() != hash:
+                raise ValueError(f"Mod payload doesn't match hash: {hash}")
+            temp_path.replace(path)
+        finally:
+            temp_path.unlink(missing_ok=True)
+        return path
+
+    def discard(self, hash: str):
+        self.get_path(hash).unlink(missing_ok=True)
+
+
+mod_downloader = ModDownloader(mod_store.path.joinpath("downloads"))
@@ -0,0 +1,506 @@
+from __future__ import annotations
+
+import base64
+import io
+import json
+import os
+import struct
+import zipfile
+from hashlib import md5
+from pathlib import Path
+from typing import Optional
+
+from .functions import (
+    DecodeFileTable,
+    DecodeProperties,
+    DecodeStoredDeflate,
+    compress_stream,
+    iter_file,
+    random_id,
+    zip_preview_path,
+)
+
+
+class ModStore:
+    """Content addressed storage for the server's mod files.
+
+    Mods are split into their inner file blobs, each stored once under the md5
+    of its content, plus a manifest per mod that lists how to put the original
+    file back together byte for byte. Rebuilt files are kept in a size capped
+    cache so hot mods don't have to be assembled on every request."""
+
+    version = 1
+    # Bumped when read_mod_paths changes, older manifests get their paths recomputed.
+    paths_version = 2
+    inline_size = 256
+
+    def __init__(self, path: Path, cache_size: int = 2 * 1024**3):
+        self.path = path
+        self.blobs_path = path.joinpath("blobs")
+        self.manifests_path = path.joinpath("manifests")
+        self.cache_path = path.joinpath("cache")
+        self.deltas_path = path.joinpath("deltas")
+        self.quarantine_path = path.joinpath("quarantine")
+        self.cache_size = cache_size
+        self._paths = {}
+        self._verifications = {}
+
+    def __str__(self):
+        return f'<ModStore "{self.path}">'
+
+    def __repr__(self):
+        return str(self)
+
+    def __contains__(self, hash: str):
+        return self.manifest_path(hash).exists() or self._loose_path(hash) is not None
+
+    def hashes(self) -> set[str]:
+        hashes = set()
+        if self.manifests_path.exists():
+            hashes.update(file.stem for file in self.manifests_path.iterdir())
+        if self.path.exists():
+            hashes.update(
+                file.stem
+                for file in self.path.iterdir()
+                if file.is_file() and file.suffix in (".tmod", ".zip")
+            )
+        return hashes
+
+    def manifest_path(self, hash: str) -> Path:
+        return self.manifests_path.joinpath(f"{hash}.json")
+
+    def blob_path(self, key: str) -> Path:
+        return self.blobs_path.joinpath(key[:2], key)
+
+    def _loose_path(self, hash: str) -> Optional[Path]:
+        for format in ("tmod", "zip"):
+            path = self.path.joinpath(f"{hash}.{format}")
+            if path.exists():
+                return path
+        return None
+
+    def get_manifest(self, hash: str) -> Optional[dict]:
+        try:
+            return json.loads(self.manifest_path(hash).read_text())
+        except FileNotFoundError:
+            return None
+
+    def add(
+        self, hash: str, format: str, data: bytes, verification: Optional[dict] = None
+    ) -> dict:
+        format = format.lower()
+        paths = read_mod_paths(format, data)
+        layout, segments, header = "raw", [(0, len(data))], None
+        try:
+            if format == "tmod":
+                layout, segments, header, data = "tmod", *_split_tmod(data)
+            elif format == "zip":
+                layout, segments = "concat", _split_zip(data)
+        except (ValueError, IndexError, zipfile.BadZipFile):
+            layout, segments, header = "raw", [(0, len(data))], None
+        data = memoryview(data)
+        manifest = {
+            "version": self.version,
+            "hash": hash,
+            "format": format,
+            "layout": layout,
+            "paths": paths,
+            "paths_version": self.paths_version,
+            "segments": [
+                self._store_segment(data[start:end]) for start, end in segments
+            ],
+        }
+        if header is not None:
+            manifest["header"] = base64.b64encode(header).decode("ascii")
+        if verification is not None:
+            manifest["verification"] = verification
+        self._write_file(self.manifest_path(hash), json.dumps(manifest).encode("utf-8"))
+        self._verifications[hash] = verification
+        return manifest
+
+    def import_file(self, path: Path, remove: bool = True) -> dict:
+        data = path.read_bytes()
+        hash = path.stem
+        manifest = self.add(hash, path.suffix[1:], data)
+        if md5(self.read(hash)).hexdigest() != md5(data).hexdigest():
+            self.manifest_path(hash).unlink()
+            raise ValueError(f"Mod {hash} doesn't rebuild to the original file")
+        if remove:
+            path.unlink()
+        return manifest
+
+    def migrate(self) -> int:
+        if not self.path.exists():
+            return 0
+        count = 0
+        for path in list(self.path.iterdir()):
+            if not path.is_file() or path.suffix not in (".tmod", ".zip"):
+                continue
+            try:
+                self.import_file(path)
+                count += 1
+            except (OSError, ValueError) as e:
+                print(f"Failed to move {path.name} into the mod store: {e}")
+        return count
+
+    def iter_mod(self, hash: str):
+        manifest = self.get_manifest(hash)
+        if manifest is None:
+            loose_path = self._loose_path(hash)
+            if loose_path is None:
+                raise FileNotFoundError(hash)
+            yield from iter_file(loose_path)
+            return
+        segments = self._iter_segments(manifest["segments"])
+        if manifest["layout"] == "tmod":
+            yield base64.b64decode(manifest["header"])
+            yield from compress_stream(segments)
+        else:
+            yield from segments
+
+    def read(self, hash: str) -> bytes:
+        return b"".join(self.iter_mod(hash))
+
+    def read_range(self, hash: str, offset: int, size: int) -> bytes:
+        """Bytes of a stored mod's segments, the payload of TMods, without the rest.
+
+        Only the blobs overlapping the range are read."""
+        manifest = self.get_manifest(hash)
+        if manifest is None:
+            raise FileNotFoundError(hash)
+        end = offset + size
+        parts = []
+        position = 0
+        for kind, value in manifest["segments"]:
+            if position >= end:
+                break
+            segment_size = self._segment_size(kind, value)
+            if position + segment_size > offset:
+                segment = b"".join(self._iter_segments([(kind, value)]))
+                parts.append(segment[max(offset - position, 0) : end - position])
+            position += segment_size
+        return b"".join(parts)
+
+    def get_path(self, hash: str, format: str) -> Optional[Path]:
+        loose_path = self.path.joinpath(f"{hash}.{format}")
+        if loose_path.exists():
+            return loose_path
+        path = self.cache_path.joinpath(f"{hash}.{format}")
+        if path.exists():
+            os.utime(path)
+            return path
+        if not self.manifest_path(hash).exists():
+            return None
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f"{path.name}.{random_id()}.tmp")
+        with open(temp_path, "wb") as f:
+            for chunk in self.iter_mod(hash):
+                f.write(chunk)
+        temp_path.replace(path)
+        self.trim_cache()
+        return path
+
+    def quarantine(self, hash: str, format: str, data: bytes, errors: list[str]):
+        """Keeps a mod that failed verification aside for inspection."""
+        self._write_file(self.quarantine_path.joinpath(f"{hash}.{format}"), data)
+        self._write_file(
+            self.quarantine_path.joinpath(f"{hash}.json"),
+            json.dumps({"hash": hash, "format": format, "errors": errors}).encode(),
+        )
+
+    def quarantined(self) -> set[str]:
+        if not self.quarantine_path.exists():
+            return set()
+        return {file.stem for file in self.quarantine_path.glob("*.json")}
+
+    def trim_cache(self):
+        files = []
+        for path in self.cache_path.iterdir():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.cache_size:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def remove(self, hash: str):
+        self.manifest_path(hash).unlink(missing_ok=True)
+        for format in ("tmod", "zip"):
+            self.path.joinpath(f"{hash}.{format}").unlink(missing_ok=True)
+            self.cache_path.joinpath(f"{hash}.{format}").unlink(missing_ok=True)
+        self._paths.pop(hash, None)
+        self._verifications.pop(hash, None)
+
+    def collect_garbage(self) -> int:
+        referenced = set()
+        if self.manifests_path.exists():
+            for path in self.manifests_path.iterdir():
+                manifest = json.loads(path.read_text())
+                referenced.update(
+                    value for kind, value in manifest["segments"] if kind == "blob"
+                )
+        removed = 0
+        if self.blobs_path.exists():
+            for path in self.blobs_path.glob("*/*"):
+                if path.name not in referenced and not path.name.endswith(".tmp"):
+                    path.unlink()
+                    removed += 1
+        return removed
+
+    def get_paths(self, hash: str) -> list[str]:
+        paths = self._paths.get(hash)
+        if paths is None:
+            manifest = self.get_manifest(hash)
+            if (
+                manifest is not None
+                and manifest.get("paths_version") == self.paths_version
+            ):
+                paths = manifest["paths"]
+            else:
+                format = manifest["format"] if manifest else None
+                if format is None:
+                    loose_path = self._loose_path(hash)
+                    if loose_path is None:
+                        raise FileNotFoundError(hash)
+                    format = loose_path.suffix[1:]
+                paths = read_mod_paths(format, self.read(hash))
+                if manifest is not None:
+                    manifest["paths"] = paths
+                    manifest["paths_version"] = self.paths_version
+                    self._write_file(
+                        self.manifest_path(hash), json.dumps(manifest).encode("utf-8")
+                    )
+            self._paths[hash] = paths
+        return paths
+
+    def get_verifications(self, hashes) -> dict[str, dict]:
+        """Stored verification results of hashes, mods never verified are left out."""
+        verifications = {}
+        for hash in hashes:
+            if hash not in self._verifications:
+                manifest = self.get_manifest(hash)
+                self._verifications[hash] = (
+                    manifest.get("verification") if manifest is not None else None
+                )
+            if self._verifications[hash] is not None:
+                verifications[hash] = self._verifications[hash]
+        return verifications
+
+    def set_verification(self, hash: str, verification: dict):
+        manifest = self._get_or_import_manifest(hash)
+        manifest["verification"] = verification
+        self._write_file(self.manifest_path(hash), json.dumps(manifest).encode("utf-8"))
+        self._verifications[hash] = verification
+
+    def _get_or_import_manifest(self, hash: str) -> dict:
+        manifest = self.get_manifest(hash)
+        if manifest is not None:
+            return manifest
+        loose_path = self._loose_path(hash)
+        if loose_path is None:
+            raise FileNotFoundError(hash)
+        return self.import_file(loose_path)
+
+    def _segment_size(self, kind: str, value: str) -> int:
+        if kind == "blob":
+            return self.blob_path(value).stat().st_size
+        return len(base64.b64decode(value))
+
+    def build_delta(self, old_hash: str, new_hash: str) -> bytes:
+        old = self._get_or_import_manifest(old_hash)
+        new = self._get_or_import_manifest(new_hash)
+        base = {}
+        offset = 0
+        for kind, value in old["segments"]:
+            size = self._segment_size(kind, value)
+            if kind == "blob":
+                base.setdefault(value, (offset, size))
+            offset += size
+        segments = []
+        blobs = set()
+        for kind, value in new["segments"]:
+            if kind == "blob" and value in base:
+                segments.append(["base", *base[value]])
+            else:
+                if kind == "blob":
+                    blobs.add(value)
+                segments.append([kind, value])
+        manifest = {
+            "version": self.version,
+            "from": old_hash,
+            "to": new_hash,
+            "format": new["format"],
+            "layout": new["layout"],
+            "base_layout": old["layout"],
+            "segments": segments,
+        }
+        if "header" in new:
+            manifest["header"] = new["header"]
+        package = io.BytesIO()
+        with zipfile.ZipFile(package, "w", zipfile.ZIP_DEFLATED) as f:
+            f.writestr("manifest.json", json.dumps(manifest))
+            for key in sorted(blobs):
+                f.write(self.blob_path(key), f"blobs/{key}")
+        data = package.getvalue()
+        apply_delta(self.read(old_hash), data)
+        return data
+
+    def get_delta_path(self, old_hash: str, new_hash: str) -> Optional[Path]:
+        path = self.deltas_path.joinpath(f"{old_hash}_{new_hash}.zip")
+        if path.exists():
+            return path
+        if old_hash not in self or new_hash not in self:
+            return None
+        self._write_file(path, self.build_delta(old_hash, new_hash))
+        return path
+
+    def build_deltas(self, pairs: list[tuple[str, str]]) -> int:
+        count = 0
+        for old_hash, new_hash in pairs:
+            try:
+                if self.get_delta_path(old_hash, new_hash) is not None:
+                    count += 1
+            except (OSError, ValueError) as e:
+                print(f"Failed to build delta {old_hash} -> {new_hash}: {e}")
+        return count
+
+    def _store_segment(self, data: memoryview) -> list:
+        if len(data) <= self.inline_size:
+            return ["data", base64.b64encode(data).decode("ascii")]
+        key = md5(data).hexdigest()
+        path = self.blob_path(key)
+        if not path.exists():
+            self._write_file(path, data)
+        return ["blob", key]
+
+    def _iter_segments(self, segments):
+        for kind, value in segments:
+            if kind == "blob":
+                yield from iter_file(self.blob_path(value), 65536)
+            else:
+                yield base64.b64decode(value)
+
+    @staticmethod
+    def _write_file(path: Path, data):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f"{path.name}.{random_id()}.tmp")
+        temp_path.write_bytes(data)
+        temp_path.replace(path)
+
+
+def apply_delta(base_data: bytes, package: bytes) -> bytes:
+    """Rebuilds a mod from the previous version and a delta package.
+
+    Segments are copied from the decoded payload (or the raw file) of the base
+    mod, read from the package blobs or taken inline from the manifest."""
+    with zipfile.ZipFile(io.BytesIO(package)) as f:
+        manifest = json.loads(f.read("manifest.json"))
+        if md5(base_data).hexdigest() != manifest["from"]:
+            raise ValueError("Base mod doesn't match the delta")
+        base = memoryview(base_data)
+        if manifest["base_layout"] == "tmod":
+            header_size = int.from_bytes(base[:8], "little")
+            base = memoryview(DecodeStoredDeflate(base[header_size:]))
+        parts = []
+        for kind, *values in manifest["segments"]:
+            if kind == "base":
+                offset, size = values
+                parts.append(base[offset : offset + size])
+            elif kind == "blob":
+                parts.append(f.read(f"blobs/{values[0]}"))
+            else:
+                parts.append(base64.b64decode(values[0]))
+    if manifest["layout"] == "tmod":
+        parts = [base64.b64decode(manifest["header"]), *compress_stream(parts)]
+    data = b"".join(parts)
+    if md5(data).hexdigest() != manifest["to"]:
+        raise ValueError("Delta doesn't rebuild the expected mod")
+    return data
+
+
+def read_mod_paths(format: str, data: bytes) -> list[str]:
+    """Game paths a mod replaces, without its preview image or metadata."""
+    try:
+        if format == "tmod":
+            data = memoryview(data)
+            header_size = int.from_bytes(data[:8], "little")
+            property_count = int.from_bytes(data[10:12], "little")
+            properties, pos = DecodeProperties(data, 12, property_count)
+            entries, _ = DecodeFileTable(data, pos, header_size)
+            names = [entry[0] for entry in entries]
+            ignored = {value for name, value in properties if name == "previewPath"}
+        elif format == "zip":
+            with zipfile.ZipFile(io.BytesIO(data)) as f:
+                names = [info.filename for info in f.infolist() if not info.is_dir()]
+                ignored = {"metadata.toml"}
+                if "metadata.toml" in names:
+                    ignored.add(zip_preview_path(f.read("metadata.toml")))
+            ignored.discard(None)
+        else:
+            return []
+    except (ValueError, IndexError, zipfile.BadZipFile):
+        return []
+    ignored = {name.lower() for name in ignored}
+    return sorted(
+        {
+            path
+            for path in (Path(name).as_posix().lower() for name in names)
+            if path not in ignored
+        }
+    )
+
+
+def _split_ranges(ranges, size):
+    segments = []
+    position = 0
+    for start, end in sorted(ranges):
+        if start < position or end > size:
+            raise ValueError("Overlapping or out of range entries")
+        if start > position:
+            segments.append((position, start))
+        if end > start:
+            segments.append((start, end))
+        position = end
+    if position < size:
+        segments.append((position, size))
+    return segments
+
+
+def _split_tmod(data):
+    data = memoryview(data)
+    header_size = int.from_bytes(data[:8], "little")
+    property_count = int.from_bytes(data[10:12], "little")
+    _, pos = DecodeProperties(data, 12, property_count)
+    entries, _ = DecodeFileTable(data, pos, header_size)
+    compressed = data[header_size:]
+    payload = DecodeStoredDeflate(compressed)
+    if b"".join(compress_stream([payload])) != compressed:
+        raise ValueError("Payload framing can't be reproduced")
+    ranges = [(offset, offset + size) for _, _, offset, size, _ in entries]
+    return _split_ranges(ranges, len(payload)), bytes(data[:header_size]), payload
+
+
+_ZIP_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+
+
+def _split_zip(data):
+    ranges = []
+    with zipfile.ZipFile(io.BytesIO(data)) as f:
+        for info in f.infolist():
+            header = _ZIP_LOCAL_HEADER.unpack_from(data, info.header_offset)
+            if header[0] != b"PK\x03\x04":
+                raise zipfile.BadZipFile("Bad local file header")
+            start = (
+                info.header_offset + _ZIP_LOCAL_HEADER.size + header[10] + header[11]
+            )
+            ranges.append((start, start + info.compress_size))
+    return _split_ranges(ranges, len(data))
+
+
+mod_store = ModStore(Path("mods"))
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+from concurrent.futures import ProcessPoolExecutor
+from enum import Enum
+from io import BytesIO
+from pathlib import Path
+from typing import Optional
+
+from PIL import Image
+
+from ..models.database.mod import TMod, ZMod
+from .functions import random_id
+from .mod_store import mod_store
+
+previews_path = Path("mods/cached_images")
+
+
+class PreviewSize(Enum):
+    SMALL = 64
+    MEDIUM = 128
+    LARGE = 256
+    ORIGINAL = 0
+
+
+def get_preview_path(hash: str, size: PreviewSize = PreviewSize.ORIGINAL) -> Path:
+    if size is PreviewSize.ORIGINAL:
+        return previews_path.joinpath(f"{hash}.png")
+    return previews_path.joinpath(f"{hash}_{size.name.lower()}.png")
+
+
+def get_missing_path(hash: str) -> Path:
+    return previews_path.joinpath(f"{hash}.none")
+
+
+def has_previews(hash: str) -> bool:
+    if get_missing_path(hash).exists():
+        return True
+    return all(get_preview_path(hash, size).exists() for size in PreviewSize)
+
+
+def _write_image(path: Path, image: Image.Image):
+    data = BytesIO()
+    image.save(data, format="PNG")
+    temp_path = path.with_name(f"{path.name}.{random_id()}.tmp")
+    temp_path.write_bytes(data.getvalue())
+    temp_path.replace(path)
+
+
+def read_preview(hash: str, format: str) -> Optional[bytes]:
+    """Reads a stored mod's preview without going through the file cache."""
+    if hash not in mod_store:
+        raise FileNotFoundError(f"Mod {hash} is not stored")
+    manifest = mod_store.get_manifest(hash)
+    if manifest is not None and manifest["layout"] == "tmod":
+        # Only the preview's part of the payload is read.
+        mod = TMod()
+        entries = mod._read_header(base64.b64decode(manifest["header"]))
+        for name, _, offset, size, _ in entries:
+            if Path(name).as_posix().lower() == mod.preview_path:
+                return mod_store.read_range(hash, offset, size)
+        return None
+    if manifest is not None:
+        format = manifest["format"]
+    data = mod_store.read(hash)
+    path = Path(f"{hash}.{format}")
+    if format == "zip":
+        return ZMod.read_bytes(path, BytesIO(data)).preview_data
+    return TMod.read_bytes(path, data).preview_data
+
+
+def build_previews(hash: str, format: str) -> bool:
+    data = read_preview(hash, format)
+    previews_path.mkdir(parents=True, exist_ok=True)
+    try:
+        if data is None:
+            raise ValueError("Mod has no preview")
+        image = Image.open(BytesIO(data))
+        image.load()
+    except (OSError, ValueError):
+        get_missing_path(hash).touch()
+        return False
+    if image.mode not in ("1", "L", "LA", "P", "RGB", "RGBA"):
+        image = image.convert("RGBA")
+    # Smallest size last, has_previews only trusts a complete set.
+    for size in reversed(PreviewSize):
+        if size is PreviewSize.ORIGINAL:
+            thumbnail = image
+        else:
+            thumbnail = image.copy()
+            thumbnail.thumbnail((size.value, size.value))
+        _write_image(get_preview_path(hash, size), thumbnail)
+    return True
+
+
+class PreviewPipeline:
+    """Builds preview thumbnails for ingested mods in a pool of worker processes."""
+
+    def __init__(self, workers: Optional[int] = None):
+        self.workers = workers
+        self._executor = None
+        self._pending = {}
+
+    def __str__(self):
+        return f"<PreviewPipeline pending={len(self._pending)}>"
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers)
+        return self._executor
+
+    def missing(self, mods: list[tuple[str, str]]) -> list[tuple[str, str]]:
+        return [
+            (hash, format)
+            for hash, format in mods
+            if hash not in self._pending
+            and hash in mod_store
+            and not has_previews(hash)
+        ]
+
+    def submit(self, hash: str, format: str) -> asyncio.Future:
+        future = self._pending.get(hash)
+        if future is None:
+            future = asyncio.wrap_future(
+                self.executor.submit(build_previews, hash, format)
+            )
+            future.add_done_callback(lambda f: self._finish(hash, f))
+            self._pending[hash] = future
+        return future
+
+    def queue(self, mods: list[tuple[str, str]]) -> int:
+        for hash, format in mods:
+            self.submit(hash, format)
+        return len(mods)
+
+    def _finish(self, hash: str, future: asyncio.Future):
+        self._pending.pop(hash, None)
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Failed to build previews for {hash}: {future.exception()}")
+
+
+preview_pipeline = PreviewPipeline()
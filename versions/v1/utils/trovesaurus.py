@@ -48,6 +48,19 @@ class TrovesaurusMod(BaseModel):
             return ""
         return v
 
+    @property
+    def update_pairs(self) -> list[tuple[TrovesaurusModFile, TrovesaurusModFile]]:
+        pairs = []
+        previous = {}
+        for file in sorted(self.files, key=lambda f: f.date):
+            format = file.format.lower()
+            if not file.hash or format not in ("tmod", "zip"):
+                continue
+            if format in previous:
+                pairs.append((previous[format], file))
+            previous[format] = file
+        return pairs
+
 
 class SearchCache(Document):
     id: Indexed(int)